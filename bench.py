@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+#
+# Trireme benchmark
+#
+# Runs the trireme pipeline against an in-memory fake Cassandra session,
+# to measure the overhead of trireme itself.
+#
+import argparse
+import itertools
+import logging
+import multiprocessing
+import pickle
+import time
+
+import count
+import settings
+from trireme.datastructures import Queues, RuntimeSettings, CassandraSettings, Token_range
+from trireme.fakecassandra import FakeTable, FakeSessionFactory
+from trireme.ratelimit import RateLimiter
+
+
+def parse_user_args():
+    """Parse commandline arguments."""
+    parser = argparse.ArgumentParser()
+    parser.description = "Trireme benchmark against an in-memory fake Cassandra"
+    parser.add_argument("--actions", type=str, default="count-rows,print-rows,delete-rows",
+                        help="Comma separated list of actions to benchmark")
+    parser.add_argument("--workers", type=str, default="1,4",
+                        help="Comma separated list of worker counts")
+    parser.add_argument("--split", type=str, default="17",
+                        help="Comma separated list of split sizes")
+    parser.add_argument("--threads", type=str, default="1",
+                        help="Comma separated list of thread counts per worker")
+    parser.add_argument("--concurrency", type=str, default="1",
+                        help="Comma separated list of concurrency values")
+    parser.add_argument("--split-mode", dest="split_mode", type=str, default="fixed", choices=["fixed", "ring"])
+    parser.add_argument("--partitions", type=int, default=20000, help="Partitions in the fake table")
+    parser.add_argument("--rows-per-partition", dest="rows_per_partition", type=int, default=1)
+    parser.add_argument("--row-size", dest="row_size", type=int, default=100, help="Bytes in the value column")
+    parser.add_argument("--latency", type=float, default=0.002, help="Query latency, seconds")
+    parser.add_argument("--row-latency", dest="row_latency", type=float, default=0,
+                        help="Additional latency per returned row, seconds")
+    parser.add_argument("--failure-rate", dest="failure_rate", type=float, default=0,
+                        help="Share of queries that time out")
+    parser.add_argument("--max-rate", dest="max_rate", type=float, default=None,
+                        help="Limit queries per second, see count.py --max-rate")
+    parser.add_argument("--debug", action="store_true", help="Enable DEBUG logging")
+    return parser.parse_args()
+
+
+class MeasuredQueue:
+    """Wraps the results queue on the consumer side to measure what goes through it."""
+
+    def __init__(self, q):
+        self.q = q
+        self.first_result = None
+        self.messages = 0
+        self.bytes = 0
+
+    def get(self, *args, **kwargs):
+        item = self.q.get(*args, **kwargs)
+        if item is not False:
+            if self.first_result is None:
+                self.first_result = time.time()
+            self.messages += 1
+            self.bytes += len(pickle.dumps(item))
+        return item
+
+
+def run(action, workers, threads, concurrency, split, args, table):
+    cas_settings = CassandraSettings()
+    cas_settings.host = "fake"
+    cas_settings.session_factory = FakeSessionFactory(table, latency=args.latency, row_latency=args.row_latency,
+                                                      failure_rate=args.failure_rate)
+    rsettings = RuntimeSettings()
+    rsettings.keyspace = "bench"
+    rsettings.table = "fake"
+    rsettings.key = "id"
+    rsettings.extra_key = "ck"
+    rsettings.split = split
+    rsettings.workers = workers
+    rsettings.threads = threads
+    rsettings.concurrency = concurrency
+    rsettings.cas_settings = cas_settings
+    rsettings.tr = Token_range(settings.default_min_token, settings.default_max_token)
+    rsettings.split_mode = args.split_mode
+    rsettings.split_ranges = count.get_split_ranges(rsettings)
+    if args.max_rate:
+        rsettings.rate_limiter = RateLimiter(args.max_rate, settings.rate_min, settings.rate_target_latency)
+
+    queues = Queues()
+    start = time.time()
+    pm = multiprocessing.Process(target=count.process_manager, args=(queues, rsettings))
+    pm.start()
+    # processes are already started with the real queue, only the consumer reads through the wrapper
+    results_queue = MeasuredQueue(queues.results_queue)
+    queues.results_queue = results_queue
+
+    if action == "count-rows":
+        rows = count.get_rows_count(queues, rsettings)
+    elif action == "print-rows":
+        rows = sum(len(batch.value) for batch in count.get_rows(queues, rsettings))
+    elif action == "delete-rows":
+        rows = count.delete_rows(queues, rsettings)
+    else:
+        raise ValueError("Unknown action {}".format(action))
+    elapsed = time.time() - start
+    pm.join()
+
+    splits = queues.stats.get("splits")
+    first_result = results_queue.first_result - start if results_queue.first_result else 0
+    return {"action": action, "workers": workers, "threads": threads, "concurrency": concurrency, "split": split,
+            "splits": splits, "rows": rows, "elapsed": elapsed,
+            "splits/s": splits / elapsed, "rows/s": rows / elapsed, "first result": first_result,
+            "msgs": results_queue.messages, "IPC B/row": results_queue.bytes / max(rows, 1)}
+
+
+def print_report(results):
+    columns = ["action", "workers", "threads", "concurrency", "split", "splits", "rows", "elapsed",
+               "splits/s", "rows/s", "first result", "msgs", "IPC B/row"]
+    print()
+    print(" | ".join("{:>12}".format(c) for c in columns))
+    for r in results:
+        print(" | ".join("{:>12.2f}".format(r[c]) if isinstance(r[c], float) else "{:>12}".format(r[c])
+                         for c in columns))
+
+
+if __name__ == "__main__":
+    args = parse_user_args()
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+    table = FakeTable(args.partitions, args.rows_per_partition, args.row_size)
+    logging.warning("Fake table has {} rows".format(len(table)))
+    results = []
+    for (action, workers, threads, concurrency, split) in itertools.product(
+            args.actions.split(","),
+            [int(w) for w in args.workers.split(",")],
+            [int(t) for t in args.threads.split(",")],
+            [int(c) for c in args.concurrency.split(",")],
+            [int(s) for s in args.split.split(",")]):
+        results.append(run(action, workers, threads, concurrency, split, args, table))
+    print_report(results)
@@ -7,28 +7,45 @@
 # kaspars@fx.lv
 #
 import argparse
+import collections
+import copy
 import datetime
+import decimal
+import itertools
 import logging
 import queue
 import sys
 import threading
 import multiprocessing
+import multiprocessing.connection
 import time
 import platform
 import os
 import random
+import uuid
 from ssl import SSLContext, PROTOCOL_TLSv1, PROTOCOL_TLSv1_2
 
 from cassandra.auth import PlainTextAuthProvider
 from cassandra.cluster import Cluster
-from cassandra.policies import DCAwareRoundRobinPolicy
-from trireme.datastructures import Result, RowForDeletion, Token_range, Mapper_task, Queues, RuntimeSettings, CassandraSettings, \
-    CassandraWorkerTask
-from trireme.presentation import human_time
+from cassandra.query import BatchStatement, BatchType, SimpleStatement
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
+from trireme.adaptive import AdaptiveSplitSizer
+from trireme.datastructures import Result, Token_range, Mapper_task, Queues, RuntimeSettings, CassandraSettings, \
+    CassandraWorkerTask, SplitFeedback, SplitPlanJob, TopK, WorkerControl
 
 # settings
 import settings
-from trireme.stats import stats_monitor, split_predicter
+from trireme.stats import SampleEstimator, stats_monitor, split_predicter
+from trireme.export import Manifest, ShardWriter
+from trireme.hll import DistinctCounter
+from trireme.journal import Journal
+from trireme.ledger import Ledger, default_participant
+from trireme.metrics import metrics_server
+from trireme.ratelimit import RateLimiter
+from trireme.routing import ReplicaRouter
+from trireme.splitplan import SplitPlan
+from trireme.tokenring import owned_ranges, subtract_ranges, tokens_from_file, tokens_from_token_map
+from trireme.trace import estimate_size, print_trace_report, start_trace, trace_record, trace_writer
 
 
 def parse_user_args():
@@ -39,7 +56,8 @@ def parse_user_args():
                         type=str,
                         choices=[
                             "count-rows", "print-rows", "update-rows",
-                            "delete-rows", "find-nulls", "find-wide-partitions"
+                            "delete-rows", "find-nulls", "find-wide-partitions", "export-rows",
+                            "count-distinct"
                         ],
                         help="What would you like to do?")
     parser.add_argument("host", type=str, help="Cassandra host")
@@ -61,7 +79,11 @@ def parse_user_args():
     parser.add_argument("--value-column",
                         type=str,
                         dest="value_column",
-                        help="Value column.")
+                        help="Value column. With find-nulls the column to look for nulls in.")
+    parser.add_argument("--print-keys",
+                        dest="print_keys",
+                        action="store_true",
+                        help="With find-nulls, print keys of the rows where the column is null")
     parser.add_argument("--filter-string",
                         type=str,
                         dest="filter_string",
@@ -70,10 +92,89 @@ def parse_user_args():
                         type=int,
                         default=18,
                         help="Split (see documentation)")
+    parser.add_argument("--split-mode",
+                        type=str,
+                        dest="split_mode",
+                        default="fixed",
+                        choices=["fixed", "ring"],
+                        help="How to build splits: fixed steps over the whole "
+                             "token range or steps within token ranges owned "
+                             "by the cluster nodes")
+    parser.add_argument("--ring-file",
+                        type=str,
+                        dest="ring_file",
+                        help="Read ring tokens from this file (one token per "
+                             "line or 'nodetool ring' output) instead of "
+                             "cluster metadata. Used with --split-mode=ring")
+    parser.add_argument("--adaptive",
+                        action="store_true",
+                        help="Tune split size while running, based on rows "
+                             "and latency of finished splits. --split is "
+                             "used as the initial split size")
+    parser.add_argument("--top",
+                        type=int,
+                        default=settings.wide_partitions_top,
+                        help="How many of the widest partitions to look for "
+                             "with find-wide-partitions")
     parser.add_argument("--workers",
                         type=int,
                         default=1,
                         help="Amount of worker processes to use")
+    parser.add_argument("--threads",
+                        type=int,
+                        default=1,
+                        help="Amount of threads in each worker process, "
+                             "sharing one Cassandra session")
+    parser.add_argument("--concurrency",
+                        type=int,
+                        default=1,
+                        help="Amount of queries each worker keeps in flight")
+    parser.add_argument("--fetch-size",
+                        type=int,
+                        dest="fetch_size",
+                        default=settings.fetch_size,
+                        help="Rows per page when reading a split")
+    parser.add_argument("--max-rate",
+                        dest="max_rate",
+                        type=float,
+                        default=None,
+                        help="Max queries per second of all workers together. "
+                             "The rate is adjusted between --min-rate and "
+                             "this, based on query latency and timeouts")
+    parser.add_argument("--min-rate",
+                        dest="min_rate",
+                        type=float,
+                        default=settings.rate_min,
+                        help="Queries per second to fall back to when the "
+                             "cluster is overloaded")
+    parser.add_argument("--target-latency",
+                        dest="target_latency",
+                        type=float,
+                        default=settings.rate_target_latency,
+                        help="Queries slower than this (seconds) make the "
+                             "rate go down")
+    parser.add_argument("--metrics-port",
+                        dest="metrics_port",
+                        type=int,
+                        default=None,
+                        help="Serve OpenMetrics on this port, at /metrics")
+    parser.add_argument("--metrics-file",
+                        dest="metrics_file",
+                        type=str,
+                        default=None,
+                        help="Write JSON snapshot of the metrics to this file "
+                             "every few seconds")
+    parser.add_argument("--trace",
+                        dest="trace",
+                        type=str,
+                        default=None,
+                        help="Write timings of every split to this CSV file "
+                             "and report the slowest and largest token ranges at the end")
+    parser.add_argument("--no-token-aware",
+                        dest="token_aware",
+                        action="store_false",
+                        help="Do not send splits to their replicas, "
+                             "let the driver pick the coordinator")
     parser.add_argument("--port",
                         type=int,
                         default=9042,
@@ -110,7 +211,47 @@ def parse_user_args():
 
     parser.add_argument("--max-token", type=int,
                        help="Max token")
+    parser.add_argument("--output-dir", dest="output_dir", type=str,
+                        help="Directory export-rows writes the shards and their manifest to")
+    parser.add_argument("--format", type=str, choices=["jsonl", "csv"], default="jsonl",
+                        help="Format of export-rows shards")
+    parser.add_argument("--gzip", action="store_true",
+                        help="Compress export-rows shards with gzip")
+    parser.add_argument("--journal", type=str,
+                        help="Record finished token ranges in this file, so that the run can be resumed")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip token ranges that are already finished according to --journal")
+    parser.add_argument("--approximate", type=float, default=None, metavar="ERROR",
+                        help="Estimate the row count from a random sample of splits, until the 95%% "
+                             "confidence interval is within this share of it, for example 0.01")
+    parser.add_argument("--time-budget", dest="time_budget", type=float, default=None,
+                        help="Stop sampling after this many seconds, with --approximate")
+    parser.add_argument("--ledger", type=str,
+                        help="Share the scan with other trireme runs using the same ledger file, "
+                             "on storage all of them can reach")
+    parser.add_argument("--participant", type=str, default=None,
+                        help="Name of this run in the ledger, host name and pid by default")
     args = parser.parse_args()
+    if args.resume and not args.journal:
+        parser.error("--resume requires --journal")
+    if args.action == "update-rows" and (args.update_key is None or args.update_value is None):
+        parser.error("update-rows requires --update-key and --update-value")
+    if args.action in ["find-nulls", "count-distinct"] and args.value_column is None:
+        parser.error("{} requires --value-column".format(args.action))
+    if args.action == "count-distinct" and (args.journal or args.ledger):
+        parser.error("count-distinct can't be resumed or shared, use it without --journal or --ledger")
+    if args.ledger and (args.journal or args.adaptive or args.action == "find-wide-partitions"):
+        parser.error("--ledger can't be used with --journal, --adaptive or find-wide-partitions")
+    if args.adaptive and args.action == "find-wide-partitions":
+        # refinement narrows splits down to single tokens, the adaptive splitter would undo that
+        parser.error("--adaptive can't be used with find-wide-partitions")
+    if args.approximate is not None and (args.action != "count-rows" or args.journal or args.ledger
+                                         or args.adaptive):
+        parser.error("--approximate works with count-rows only, without --journal, --ledger or --adaptive")
+    if args.time_budget is not None and args.approximate is None:
+        parser.error("--time-budget requires --approximate")
+    if args.action == "export-rows" and args.output_dir is None:
+        parser.error("export-rows requires --output-dir")
     return args
 
 
@@ -129,11 +270,16 @@ def get_cassandra_session(host,
     py_version = platform.python_version_tuple()
 
 
+    if dc:
+        load_balancing_policy = TokenAwarePolicy(DCAwareRoundRobinPolicy(local_dc=dc))
+    else:
+        load_balancing_policy = None
+
     if ssl_cert is None and ssl_key is None:
         # skip setting up ssl
         ssl_context = None
         cluster = Cluster([host],
-                          port=port,
+                          port=port, load_balancing_policy=load_balancing_policy,
                           auth_provider=auth_provider)
     else:
         if ssl_v1:
@@ -146,22 +292,16 @@ def get_cassandra_session(host,
             ssl_context.load_cert_chain(certfile=ssl_cert, keyfile=ssl_key)
             if cacert:
                 ssl_context.load_verify_locations(cacert)
-            if dc:
-                cluster = Cluster([host],
-                                  port=port, load_balancing_policy=DCAwareRoundRobinPolicy(local_dc=dc),
-                                  ssl_context=ssl_context,
-                                  auth_provider=auth_provider)
-            else:
-                cluster = Cluster([host],
-                                  port=port,
-                                  ssl_context=ssl_context,
-                                  auth_provider=auth_provider)
+            cluster = Cluster([host],
+                              port=port, load_balancing_policy=load_balancing_policy,
+                              ssl_context=ssl_context,
+                              auth_provider=auth_provider)
         else:
             ssl_options = {'certfile': ssl_cert,
                            'keyfile': ssl_key,
                            'ssl_version': PROTOCOL_TLSv1_2}
             cluster = Cluster([host],
-                              port=port,
+                              port=port, load_balancing_policy=load_balancing_policy,
                               ssl_options=ssl_options,
                               auth_provider=auth_provider)
 
@@ -177,620 +317,640 @@ def get_cassandra_session(host,
     return session
 
 
-def find_null_cells(session, keyspace, table, key_column, value_column):
-    """Scan table looking for 'Null' values in the specified column.
+def connect(cas_settings, host):
+    """Return a session to the host.
 
-    Finding 'Null' columns in a table.
+    If a session factory is set in Cassandra settings (tests, benchmarks),
+    it is used instead of connecting to a real cluster.
+    """
+    if cas_settings.session_factory:
+        return cas_settings.session_factory(host)
+    return get_cassandra_session(host, cas_settings.port, cas_settings.user,
+                                 cas_settings.password, cas_settings.ssl_cert, cas_settings.ssl_key, cas_settings.dc,
+                                 cas_settings.cacert, cas_settings.ssl_v1)
 
-    'key_column' - the column that cotains some meaningful key/id.
-    Your primary key most likely.
-    'value_column' - the column where you wish to search for 'Null'
 
-    Having 'Null' cells in Cassandra is the same as not having them.
-    However if you don't control the data model or cannot change it
-    for whatever reason but still want to know
-    how many such 'Null' cells you have, you are bit out of luck.
-    Filtering by 'Null' is not something that you can do in Cassandra.
-    So what you can do is to query them and look for 'Null' in the result.
-    """
+def get_ring_tokens(rsettings):
+    """Get the ring tokens either from the ring file or from cluster metadata."""
+    if rsettings.ring_file:
+        return tokens_from_file(rsettings.ring_file)
+    cas_settings = rsettings.cas_settings
+    session = connect(cas_settings, cas_settings.host.split(",")[0])
+    tokens = tokens_from_token_map(session.cluster.metadata.token_map)
+    session.cluster.shutdown()
+    return tokens
 
-    # TODO: this is just a stub for now, not fully implemented
-
-    session.execute("use {}".format(keyspace))
-
-    sql_template = "select {key},{column} from {keyspace}.{table}"
-    result_list = []
-
-    sql = sql_template.format(keyspace=keyspace,
-                              table=table,
-                              key=key_column,
-                              column=value_column)
-    logging.debug("Executing: {}".format(sql))
-    result = session.execute(sql)
-    result_list = [r for r in result if getattr(r, value_column) is None]
-
-
-def batch_sql_query(sql_statement, key_name, key_list, dry_run=False):
-    """Run a query on the specifies list of primary keys."""
-
-    for key in key_list:
-        if isinstance(key, dict):
-            sql = "{sql_statement} where ".format(sql_statement=sql_statement)
-            andcount = 0
-            for k in key:
-                value = key[k]
-                if isinstance(value, str):
-                    value = "'{}'".format(value)
-                sql += "{key_name} = {key}".format(key_name=k, key=value)
-                if andcount < 1:
-                    andcount += 1
-                    sql += " and "
-        else:
-            sql = "{sql_statement} where {key_name} = {key}".format(
-                sql_statement=sql_statement, key_name=key_name, key=key)
 
-        logging.debug("Executing: {}".format(sql))
-        if dry_run:
-            logging.info("Would execute: {}".format(sql))
-        else:
-            result = session.execute(sql)
-            logging.debug(result)
-            time.sleep(0.1)
+def get_split_ranges(rsettings):
+    """Return list of (min, max) token ranges that the splitter should split."""
+    if rsettings.split_mode == "ring":
+        tokens = get_ring_tokens(rsettings)
+        logging.info("Found {} tokens in the ring".format(len(tokens)))
+        return owned_ranges(tokens, rsettings.tr)
+    return [(rsettings.tr.min, rsettings.tr.max)]
 
 
-def execute_statement(sql_statement):
-    logging.debug("Deleting: {}".format(sql_statement))
-    result = session.execute(sql_statement)
-    return result
+def put_unless_killed(q, item, kill):
+    """Put item in the queue, waiting for free space unless the kill event gets set."""
+    while not kill.is_set():
+        try:
+            q.put(item, True, 1)
+            return True
+        except queue.Full:
+            continue
+    return False
 
 
-def process_reaper(process_queue):
-    max_attempts = 10
-    current = 0
-    logging.debug("Process reaper: there are {} processes in the queue".format(process_queue.qsize()))
-    while process_queue.qsize() > 0:
-        if current == max_attempts:
-            logging.debug("Process reaper exiting.")
-            break
-        current +=1
-        process = process_queue.get()
-        if process.is_alive():
-            logging.debug("Process {} is still running, putting back into queue".format(process))
-            process_queue.put(process)
+def adaptive_splitter(queues, rsettings):
+    """Splitter that tunes split size based on feedback from workers.
+
+    Only a limited amount of splits is kept in flight, so that feedback from
+    finished splits is taken into account before their neighbours are issued.
+    Failed splits are subdivided and retried before any new splits.
+    """
+    sizer = AdaptiveSplitSizer(pow(10, rsettings.split),
+                               pow(10, settings.adaptive_min_split),
+                               pow(10, settings.adaptive_max_split),
+                               settings.adaptive_target_rows,
+                               settings.adaptive_max_latency)
+    # every thread of a worker runs up to concurrency splits at once
+    max_in_flight = rsettings.workers * rsettings.threads * rsettings.concurrency * settings.adaptive_in_flight
+    ranges = list(rsettings.split_ranges)
+    retries = []
+    attempts = {}
+    in_flight = 0
+    logging.info("Preparing adaptive splits, starting with split size {}".format(rsettings.split))
+    while (ranges or retries or in_flight > 0) and not queues.kill.is_set():
+        # wait for feedback only if there is nothing else we can do
+        block = in_flight >= max_in_flight or not (ranges or retries)
+        while True:
+            try:
+                feedback = queues.feedback_queue.get(block, 1)
+            except queue.Empty:
+                break
+            block = False
+            in_flight -= 1
+            if feedback.failed:
+                split = (feedback.min, feedback.max)
+                attempt = attempts.pop(split, 0) + 1
+                if attempt > settings.adaptive_max_retries:
+                    logging.warning("Giving up on split {} after {} attempts".format(split, attempt))
+                    queues.stats.add("failed")
+                    continue
+                subsplits = sizer.subdivide(feedback.min, feedback.max)
+                logging.debug("Split {} failed, retrying as {} splits".format(split, len(subsplits)))
+                for subsplit in subsplits:
+                    attempts[subsplit] = attempt
+                retries.extend(subsplits)
+            else:
+                sizer.feedback(feedback.rows, feedback.latency)
+
+        if in_flight >= max_in_flight:
+            continue
+        if retries:
+            split = retries.pop(0)
+        elif ranges:
+            (range_min, range_max) = ranges[0]
+            i_max = min(range_min + sizer.step, range_max)
+            split = (range_min, i_max)
+            if i_max >= range_max:
+                ranges.pop(0)
+            else:
+                ranges[0] = (i_max, range_max)
         else:
-            logging.debug("Reaping process {}".format(process))
+            continue
+        if not put_unless_killed(queues.split_queue, split, queues.kill):
+            logging.debug("Splitter stopping due to kill event.")
+            return
+        queues.stats.add("splits")
+        in_flight += 1
 
-def batch_executer(cas_settings,batch_q, batch_result_q):
-    logging.info("STARTING batch executor with batch q size: {}".format(batch_q.qsize()))
-    s = get_cassandra_session(cas_settings[0],cas_settings[1],cas_settings[2],cas_settings[3],cas_settings[4],cas_settings[5],cas_settings[6])
-    time.sleep(10)
-    while batch_q.qsize() >0:
-        try:
-            (min, max, sql) = batch_q.get()
-            logging.info("Executing via BATCH: {}".format(sql))
-            result = s.execute(sql)
-            r = Result(min, max, result)
-            batch_result_q.put(r)
-            logging.info("Result: {}".format(r))
-        except Exception as e:
-            logging.warning(
-                "Got Cassandra exception: "
-                "{msg} when running query: {sql}"
-                    .format(sql=sql, msg=e))
+    queues.stats.flush()
+    put_unless_killed(queues.split_queue, False, queues.kill)
+    logging.debug("Adaptive splitter is done. All splits finished, last {}".format(sizer))
 
-def sql_query_q(cas_settings,delete_queue,getter_counter,sql_statement, key_column, result_list, failcount, split_queue,
-              filter_string, kill_queue, extra_key):
-    while True:
-        if kill_queue.qsize() > 0:
-            logging.warning("Aborting query on request.")
-            return
-        if split_queue.qsize() >0:
-            if delete_queue.qsize() > 2000: # TODO: 2000 should be enough for anyone, right? :)
-                # slow down with SELECTS if the DELETE queue is already big,
-                # as there is no point running if DELETE is not keeping up
-                time.sleep(1)
-
-            if extra_key:
-                sql_base_template = "{sql_statement} where token({key_column}, {extra_key}) " \
-                                    ">= {min} and token({key_column}, {extra_key}) < {max}"
-            else:
-                sql_base_template = "{sql_statement} where token({key_column}) " \
-                                    ">= {min} and token({key_column}) < {max}"
-            if filter_string:
-                sql_base_template += " and {}".format(filter_string)
-
-
-            # prepare query for execution and then based on queue size, either execute within this thread or delegate in a batch to a separate process
-
-            if split_queue.qsize() > 1000:
-                # do the batch approach and get a list of splits from the queue
-                batch_q = multiprocessing.Queue()
-                batch_result_q = multiprocessing.Queue()
-                for i in range(100):
-                    (min, max) = split_queue.get()
-                    sql = sql_base_template.format(sql_statement=sql_statement,
-                                                   min=min,
-                                                   max=max,
-                                                   key_column=key_column, extra_key=extra_key)
-                    batch_q.put((min, max, sql))
-                    p = multiprocessing.Process(target=batch_executer, args=(cas_settings,batch_q, batch_result_q))
-                    p.start()
-
-                    logging.info("Batch finished: {} / {} ".format(batch_q.qsize(), batch_result_q.qsize()))
 
-            else:
-                # handle query here in the thread
-                (min, max) = split_queue.get()
+def ledger_splitter(queues, rsettings):
+    """Splitter that leases chunks of the token ranges from the shared work ledger.
 
-                sql = sql_base_template.format(sql_statement=sql_statement,
-                                               min=min,
-                                               max=max,
-                                               key_column=key_column, extra_key=extra_key)
-                try:
-                    if result_list.qsize() % 100 == 0:
-                        logging.debug("Executing: {}".format(sql))
-                    result = session.execute(sql)
-                    getter_counter.put(0)
-                    r = Result(min, max, result)
-                    result_list.put(r)
-                except Exception as e:
-                    failcount += 1
-                    logging.warning(
-                                    "Got Cassandra exception: "
-                                    "{msg} when running query: {sql}"
-                                    .format(sql=sql, msg=e))
-        else:
-            logging.debug("Stopping getter thread due to zero split queue size.")
-            break
+    A chunk is leased only when the main process has finished enough of
+    the chunks leased before, so that we hold little more than the workers
+    can run at once, and participants that join later still get work.
+    Once there is nothing left to lease, we keep checking for expired
+    leases of other participants until they are done too, so that chunks of
+    a participant that died get scanned.
+    """
+    ledger = Ledger(rsettings.ledger_path, None, rsettings.participant)
+    ledger.connect()
+    step = pow(10, rsettings.split)
+    running = rsettings.workers * rsettings.threads * rsettings.concurrency
+    max_leased = settings.ledger_leased_chunks
+    chunks = 0
+    while not queues.kill.is_set():
+        # leases are renewed on time, even while no split finishes
+        ledger.commit()
+        if ledger.leased() >= max_leased:
+            queues.kill.wait(settings.ledger_lease_check_interval)
+            continue
+        chunk = ledger.lease()
+        if chunk is None:
+            if not ledger.others_working():
+                break
+            logging.debug("Nothing to lease, waiting for other participants")
+            queues.kill.wait(settings.ledger_poll_interval)
+            continue
+        chunks += 1
+        (chunk_min, chunk_max) = chunk
+        # small chunks are leased a few more at once, enough to keep all workers busy
+        chunk_splits = -(-(chunk_max - chunk_min) // step)
+        max_leased = max(settings.ledger_leased_chunks, 1 + running // chunk_splits)
+        for i in range(chunk_min, chunk_max, step):
+            if not put_unless_killed(queues.split_queue, (i, min(i + step, chunk_max)), queues.kill):
+                logging.debug("Splitter stopping due to kill event.")
+                ledger.close(release=False)
+                return
+            queues.stats.add("splits")
+        queues.stats.flush()
+
+    queues.stats.flush()
+    put_unless_killed(queues.split_queue, False, queues.kill)
+    logging.debug("Ledger splitter is done, leased {} chunks".format(chunks))
+    # splits in flight may take longer than a lease, so leases are renewed until
+    # the run is over, chunks left unfinished are released by the main process
+    while not queues.kill.wait(ledger.lease_time / 4):
+        ledger.commit()
+    ledger.close(release=False)
+
+
+def deletes_partitions(rsettings):
+    """Return True if whole partitions are deleted, as no filter is used and partitions have more rows."""
+    (partition_columns, clustering_columns) = get_primary_key(rsettings)
+    return not rsettings.filter_string and bool(clustering_columns)
+
+
+def delete_rows(queues, rsettings, journal=None):
+    # rows are deleted by the workers right after they are read, grouped
+    # by partition (see delete_statements), what we get back is how many
+    # of them were deleted
+    (partition_columns, clustering_columns) = get_primary_key(rsettings)
+    if deletes_partitions(rsettings):
+        # whole partitions are deleted, only their keys are needed
+        sql_statement = select_statement(rsettings, partition_columns, distinct=True)
+        deleted_what = "partitions"
+    else:
+        sql_statement = select_statement(rsettings, partition_columns + clustering_columns)
+        deleted_what = "rows"
+    deleted = get_rows_count(queues, rsettings, journal, sql_statement, task_type="delete")
+    print("Deleted {} {} from {keyspace}.{table}".format(deleted, deleted_what, keyspace=rsettings.keyspace,
+                                                        table=rsettings.table))
+    return deleted
 
-def sql_query(sql_statement, key_column, result_list, failcount, sql_list,
-              filter_string, kill_queue, extra_key):
-    while len(sql_list) > 0:
-        if kill_queue.qsize() > 0:
-            logging.warning("Aborting query on request.")
-            return
-        (min, max) = sql_list.pop()
-        if extra_key:
-            sql_base_template = "{sql_statement} where token({key_column}, {extra_key}) " \
-                                ">= {min} and token({key_column}, {extra_key}) < {max}"
-        else:
-            sql_base_template = "{sql_statement} where token({key_column}) " \
-                            ">= {min} and token({key_column}) < {max}"
-        if filter_string:
-            sql_base_template += " and {}".format(filter_string)
-        sql = sql_base_template.format(sql_statement=sql_statement,
-                                       min=min,
-                                       max=max,
-                                       key_column=key_column, extra_key=extra_key)
+
+def cql_value(value, cql_type):
+    """Convert command line value to what the driver binds to a column of 'cql_type'.
+
+    Raises ValueError if the value is not valid for the type, or columns of
+    the type can't be set from the command line.
+    """
+    if cql_type == "counter":
+        raise ValueError("counter columns can only be incremented, not set")
+    if cql_type in ["text", "varchar", "ascii", "inet"]:
+        return value
+    if cql_type in ["int", "bigint", "smallint", "tinyint", "varint"]:
+        return int(value)
+    if cql_type in ["float", "double"]:
+        return float(value)
+    if cql_type == "decimal":
         try:
-            if result_list.qsize() % 100 == 0:
-                logging.debug("Executing: {}".format(sql))
-            result = session.execute(sql)
-            r = Result(min, max, result)
-            result_list.put(r)
-        except Exception as e:
-            failcount += 1
-            logging.warning(
-                            "Got Cassandra exception: "
-                            "{msg} when running query: {sql}"
-                            .format(sql=sql, msg=e))
-
-
-def splitter(queues, rsettings):
-    tr = rsettings.tr
-    i = tr.min
-    predicted_split_count = split_predicter(tr, rsettings.split)
-    logging.info("Preparing splits with split size {}".format(rsettings.split))
-    logging.info("Predicted split count is {} splits".format(predicted_split_count))
-    splitcounter = 0
-    while i <= tr.max - 1:
-        if queues.split_queue.full():
-            logging.debug("There are {} splits prepared. Pausing for a second.".format(splitcounter))
-            time.sleep(0.5)
-        else:
-            i_max = i + pow(10, rsettings.split)
-            if i_max > tr.max:
-                i_max = tr.max  # don't go higher than max_token
-            queues.split_queue.put((i, i_max))
-            queues.stats_queue_splits.put(0)
-            splitcounter+=1
-            i = i_max
-
-    # kill pill for split queue, signaling that we are done
-    queues.split_queue.put(False)
-    logging.debug("Splitter is done. All splits created")
-
-
-def distributed_sql_query(sql_statement, cas_settings, queues, rsettings):
-    start_time = datetime.datetime.now()
-    result_list = result_queue
-    failcount = 0
-    thread_count = 1
-    kill_queue = queue.Queue()  # TODO: change this to an event?
-
-    backoff_counter = 0
-    tm = None
+            return decimal.Decimal(value)
+        except decimal.InvalidOperation:
+            raise ValueError("invalid decimal: {}".format(value))
+    if cql_type == "boolean":
+        if value.lower() not in ["true", "false"]:
+            raise ValueError("invalid boolean: {}".format(value))
+        return value.lower() == "true"
+    if cql_type in ["uuid", "timeuuid"]:
+        return uuid.UUID(value)
+    if cql_type == "blob":
+        return bytes.fromhex(value[2:] if value.lower().startswith("0x") else value)
+    if cql_type == "timestamp":
+        return datetime.datetime.fromisoformat(value)
+    if cql_type == "date":
+        return datetime.date.fromisoformat(value)
+    raise ValueError("columns of type {} can't be set from the command line".format(cql_type))
+
+
+def column_type(session, rsettings, column):
+    """Return CQL type of the column, from the cluster metadata. None if the column is not found there."""
+    keyspace = session.cluster.metadata.keyspaces.get(rsettings.keyspace)
+    table = keyspace.tables.get(rsettings.table) if keyspace else None
+    if table is None or column not in table.columns:
+        return None
+    return table.columns[column].cql_type
+
+
+def get_update_value(rsettings, update_key, update_value):
+    """Return command line value converted for the column that is updated.
+
+    Raises ValueError if the column is not found or the value is not valid for its type.
+    """
+    session = connect(rsettings.cas_settings, rsettings.cas_settings.host.split(",")[0])
     try:
-        while True:
-            if split_queue.qsize() >0:
-                if backoff_counter >0:
-                    backoff_counter =0 # reset backoff counter
-
-                if get_process_queue.qsize() < thread_count:
-                    thread = threading.Thread(
-                        target=sql_query_q,
-                        args=(cas_settings,delete_queue,getter_counter,sql_statement, key_column, result_list, failcount,
-                              split_queue, filter_string, kill_queue, extra_key))
-                    thread.start()
-                    logging.info("Started thread {}".format(thread))
-                    get_process_queue.put(thread)
-                else:
-                    logging.info("Max process count reached")
-                    logging.info("{} more queries remaining".format(split_queue.qsize()))
-                    res_count = result_list.qsize()
-                    logging.info("{} results so far".format(res_count))
-                    n = datetime.datetime.now()
-                    delta = n - start_time
-                    elapsed_time = delta.total_seconds()
-                    logging.info("Elapsed time: {}.".format(
-                        human_time(elapsed_time)))
-                    if res_count > 0:
-                        result_per_sec = res_count / elapsed_time
-                        logging.info("{} results / s".format(result_per_sec))
-                    time.sleep(10)
-            else:
-                backoff_counter += 1
-                logging.debug("No splits in the split queue. Will sleep {} sec".format(backoff_counter))
-                time.sleep(backoff_counter)
-                process_reaper(get_process_queue)
-
-    except KeyboardInterrupt:
-        logging.warning("Ctrl+c pressed, asking all threads to stop.")
-        kill_queue.put(0)
-        time.sleep(2)
-        logging.info("{} more queries remaining".format(split_queue.qsize()))
-        logging.info("{} results so far".format(res_count))
-
-    if failcount > 0:
-        logging.warning(
-            "There were {} failures during the query.".format(failcount))
-    return result_list
-
-def threaded_reductor(input_queue, output_queue):
-    """Do the reduce part of map/reduce and return a list of rows."""
-    backoff_timer = 0
-    while True:
-        if input_queue.qsize() == 0:
-            backoff_timer+=1
-            logging.debug("No results to reduce, reducer waiting for {} sec".format(backoff_timer))
-            time.sleep(backoff_timer)
-        else:
-            if backoff_timer >0:
-                backoff_timer = 0
-            result = input_queue.get()
-            for row in result.value:
-                # for deletion, we want to be token range aware, so we pass token range information as well
-                rd = RowForDeletion(result.min, result.max, row)
-                output_queue.put(rd)
-
-
-def delete_preparer(delete_preparer_queue, delete_queue, keyspace, table, key, extra_key):
-    sql_template = "delete from {keyspace}.{table}"
-    sql_statement = sql_template.format(keyspace=keyspace, table=table)
-    backoff_timer=0
-    while True:
-        if delete_preparer_queue.qsize() == 0:
-            backoff_timer+=1
-            logging.debug("Delete preparer sleeping for {} sec".format(backoff_timer))
-            time.sleep(backoff_timer)
-        else:
-            if backoff_timer > 0:
-                backoff_timer = 0 #reset backoff timer
-
-            # get item from queue
-            row_to_prepare_with_tokens = delete_preparer_queue.get()
-            row_to_prepare = row_to_prepare_with_tokens.row
-
-            prepared_dictionary = {}
-            prepared_dictionary[key] = getattr(row_to_prepare, key)
-            prepared_dictionary[extra_key] = getattr(row_to_prepare, extra_key)
-
-            token_min = "token({key},{extra_key}) >= {token_min}".format(key=key, extra_key=extra_key,token_min=row_to_prepare_with_tokens.min)
-            token_max = "token({key},{extra_key}) < {token_max}".format(key=key, extra_key=extra_key,token_max=row_to_prepare_with_tokens.max)
-
-            sql = "{sql_statement} where {token_min} and {token_max} and ".format(sql_statement=sql_statement, token_min=token_min, token_max=token_max)
-
-            #
-            #
-            andcount = 0
-            for rkey in prepared_dictionary:
-                value = prepared_dictionary[rkey]
-                # cassandra is timezone aware, however the response that we would have received
-                # previously does not contain timezone, so we need to add it manually
-                if isinstance(value, datetime.datetime):
-                    value = value.replace(tzinfo=datetime.timezone.utc)
-                value = "'{}'".format(value)
-                sql += "{key_name} = {qkey}".format(key_name=rkey, qkey=value)
-                if andcount < 1:
-                    andcount += 1
-                    sql += " and "
-            delete_queue.put(sql)
-
-
-
-def delete_rows(queues, rsettings):
-    for row in get_rows(queues, rsettings):
-        sql_template = "delete from {keyspace}.{table} where token({key},{extra_key}) >= {min} and token({key},{extra_key}) < {max} and {key} = '{value}' and {extra_key} = '{extra_value}'"
-        sql_statement = sql_template.format(keyspace=rsettings.keyspace, table=rsettings.table, key=rsettings.key, extra_key=rsettings.extra_key, min=row.min, max=row.max, value=row.value.get(rsettings.key), extra_value=utc_time(row.value.get(rsettings.extra_key)))
-        t = CassandraWorkerTask(sql_statement, (row.min, row.max))
-        t.task_type = "delete" # used for statistics purpose only
-        queues.worker_queue.put(t)
-        queues.stats_queue_delete_scheduled.put(0)
-
-
-def update_rows(session,
-                keyspace,
-                table,
-                key,
-                update_key,
-                update_value,
-                split,
-                filter_string,
-                extra_key=None):
-    """Update specified rows by setting 'update_key' to 'update_value'.
+        cql_type = column_type(session, rsettings, update_key)
+    finally:
+        session.cluster.shutdown()
+    if cql_type is None:
+        raise ValueError("column {} not found in {}.{}".format(update_key, rsettings.keyspace, rsettings.table))
+    return cql_value(update_value, cql_type)
 
-    When Updating rows in Cassandra you can't filter by token range.
-    So what we do is find all the primary keys for the rows that
-    we would like to update, and then run an update in a for loop.
-    """
-    session.execute("use {}".format(keyspace))
-    rows = get_rows(session, keyspace, table, key, split, update_key,
-                    filter_string, extra_key)
-    update_list = []
-    for row in rows:
-        if extra_key:
-            update_list.append({
-                key: getattr(row, key),
-                extra_key: getattr(row, extra_key)
-            })  # use tuple of key, extra_key
-        else:
-            update_list.append(getattr(row, key))
-    logging.info("Updating {} rows".format(len(update_list)))
+
+def update_sql(rsettings, update_key):
+    """Return update statement without the where clause, workers bind the value and add the primary key columns."""
+    return "update {keyspace}.{table} set {update_key} = ?".format(
+        keyspace=rsettings.keyspace, table=rsettings.table, update_key=update_key)
+
+
+def confirm_update(rsettings, update_key, update_value):
+    """Ask user to confirm the update. Returns False if the user refuses."""
     logging.info(
                 "Updating rows and setting {update_key} to new value "
                 "{update_value} where filtering string is: {filter_string}"
                 .format(update_key=update_key,
                         update_value=update_value,
-                        filter_string=filter_string))
-
-    # surround update value with quotes in case it is a string,
-    # but don't do it if it looks like a string
-    # but in reality is meant to be a a boolean
-    booleans = ["true", "false"]
-    if isinstance(update_value, str):
-        if update_value.lower() not in booleans:
-            update_value = "'{}'".format(update_value)
-
-    sql_template = "update {keyspace}.{table} set "\
-                   "{update_key} = {update_value}"
-    sql_statement = sql_template.format(keyspace=keyspace,
-                                        table=table,
-                                        update_key=update_key,
-                                        update_value=update_value)
-    logging.info(sql_statement)
-
+                        filter_string=rsettings.filter_string))
+    print("{} -- {} = {!r}".format(update_sql(rsettings, update_key), update_key, update_value))
     while True:
         response = input(
             "Are you sure you want to continue? (y/n)").lower().strip()
         if response == "y":
-            break
+            return True
         elif response == "n":
             logging.warning("Aborting upon user request")
-            return 1
-    result = batch_sql_query(sql_statement, key, update_list, False)
+            return False
+
+
+def update_rows(queues, rsettings, update_key, update_value, journal=None):
+    """Update specified rows by setting 'update_key' to 'update_value'.
+
+    When Updating rows in Cassandra you can't filter by token range.
+    So workers read the rows that match the filter split by split, and
+    update every row they read by its primary key right away.
+    The value is bound to the update statement, converted for the column
+    with get_update_value.
+    """
+    columns = sum(get_primary_key(rsettings), [])
+    updated = get_rows_count(queues, rsettings, journal, select_statement(rsettings, columns), task_type="update",
+                             write_sql=update_sql(rsettings, update_key), write_values=[update_value])
+    print("Updated {} rows in {keyspace}.{table}".format(updated, keyspace=rsettings.keyspace, table=rsettings.table))
     logging.info("Operation complete.")
+    return updated
 
 
-def get_rows(queues, rsettings):
-    """Generator that returns rows as we get them from worker"""
+def consume_results(queues, rsettings, journal=None, idle=None):
+    """Generator that returns results from the results queue until all workers are done.
 
-    sql_template = "select * from {keyspace}.{table}"
-    sql_statement = sql_template.format(keyspace=rsettings.keyspace, table=rsettings.table)
-    mt = Mapper_task(sql_statement, rsettings.key, rsettings.filter_string)
-    mt.parser = get_result_parser
-    queues.mapper_queue.put(mt)
-    while True:
-        if queues.results_queue.empty():
+    Every worker sends a kill pill (False) when it has finished, so we are
+    done once there is one from each of them. Then all processes are asked
+    to stop. 'idle' is called whenever no result comes within a second.
+    """
+    finished_workers = 0
+    while finished_workers < rsettings.workers:
+        try:
+            res = queues.results_queue.get(True, 1)
+        except queue.Empty:
             logging.debug("Waiting on results...")
-            time.sleep(5)
-        else:
-            yield queues.results_queue.get()
-            queues.stats_queue_results_consumed.put(0)
+            queues.stats.flush()
+            if journal:
+                journal.commit()
+            if idle:
+                idle()
+            continue
+        if res is False:
+            finished_workers += 1
+            logging.debug("{}/{} workers finished".format(finished_workers, rsettings.workers))
+            continue
+        if res.failed:
+            journal.fail(res.min, res.max)
+            continue
+        yield res
+    # send kill signal to process manager to stop all processes
+    queues.stats.flush()
+    queues.kill.set()
+
+
+def select_statement(rsettings, columns=None, distinct=False):
+    """Return select statement for the columns, all of them if 'columns' is None."""
+    projection = ", ".join(columns) if columns else "*"
+    if distinct:
+        projection = "distinct " + projection
+    return "select {projection} from {keyspace}.{table}".format(
+        projection=projection, keyspace=rsettings.keyspace, table=rsettings.table)
 
 
+def key_columns(rsettings):
+    columns = [rsettings.key]
+    if rsettings.extra_key:
+        columns.append(rsettings.extra_key)
+    return columns
 
 
+def value_columns(rsettings):
+    """Return list of columns given with --value-column, it can be a comma separated list."""
+    if not rsettings.value_column:
+        return []
+    return [c.strip() for c in rsettings.value_column.split(",")]
 
-def get_rows_count(queues, rsettings):
 
+def get_primary_key(rsettings):
+    """Return partition key and clustering columns of the table, from the cluster metadata.
 
-    sql_template = "select count(*) from {keyspace}.{table}"
+    They are looked up once and kept in 'rsettings'.
+    """
+    if rsettings.primary_key is None:
+        session = connect(rsettings.cas_settings, rsettings.cas_settings.host.split(",")[0])
+        try:
+            rsettings.primary_key = primary_key_columns(session, rsettings)
+        finally:
+            session.cluster.shutdown()
+    return rsettings.primary_key
+
+
+def get_rows(queues, rsettings, journal=None, task_type="select", columns=None, distinct=False, parser=None):
+    """Generator that returns batches of rows as we get them from workers.
+
+    Each batch is a Result with the token range of the split and
+    a list of rows in its value. Once the consumer is done with the last
+    batch of a split, the split is recorded in the journal.
+    Only 'columns' are selected, keys and value columns by default.
+    Rows the parser returns None for are not sent by the workers.
+    """
 
-    sql_statement = sql_template.format(keyspace=rsettings.keyspace, table=rsettings.table)
-    count = 0
-    aggregate = True
+    if columns is None:
+        columns = key_columns(rsettings) + value_columns(rsettings)
+    sql_statement = select_statement(rsettings, columns, distinct)
     mt = Mapper_task(sql_statement, rsettings.key, rsettings.filter_string)
-    mt.parser = count_result_parser;
+    mt.parser = parser or get_result_parser
+    mt.task_type = task_type
     queues.mapper_queue.put(mt)
+    split_rows = {}
+    for batch in consume_results(queues, rsettings, journal):
+        yield batch
+        split = (batch.min, batch.max)
+        split_rows[split] = split_rows.get(split, 0) + len(batch.value)
+        if batch.complete:
+            queues.stats.add("results_consumed")
+            rows = split_rows.pop(split)
+            if journal:
+                journal.record(batch.min, batch.max, rows)
+
+
+def get_split_counts(queues, rsettings, journal=None, sql_statement=None, parser=None, task_type="count",
+                     write_sql=None, write_values=None, idle=None):
+    """Generator that returns row count of every split as we get them from workers.
+
+    Workers add up what the parser returns for every row of a page, and
+    pages of a split are added up here. Delete and update tasks send the
+    number of rows they deleted or updated. With 'write_sql' workers execute
+    that statement for every row they read, with 'write_values' and the
+    row's primary key bound to it.
+    """
+    if sql_statement is None:
+        sql_template = "select count(*) from {keyspace}.{table}"
+        sql_statement = sql_template.format(keyspace=rsettings.keyspace, table=rsettings.table)
+    mt = Mapper_task(sql_statement, rsettings.key, rsettings.filter_string)
+    mt.parser = parser or count_result_parser
+    mt.task_type = task_type
+    mt.write_sql = write_sql
+    mt.write_values = write_values or []
+    queues.mapper_queue.put(mt)
+    split_counts = {}
+    for res in consume_results(queues, rsettings, journal, idle):
+        split = (res.min, res.max)
+        count = split_counts.pop(split, 0) + sum(res.value)
+        if not res.complete:
+            split_counts[split] = count
+            continue
+        queues.stats.add("results_consumed")
+        yield Result(res.min, res.max, count)
+
+
+def get_rows_count(queues, rsettings, journal=None, sql_statement=None, parser=None, task_type="count",
+                   write_sql=None, write_values=None):
     total = 0
+    if journal:
+        # when resuming, start from what was counted before
+        total = journal.total()
+    for res in get_split_counts(queues, rsettings, journal, sql_statement, parser, task_type, write_sql,
+                                write_values):
+        total += res.value
+        if journal:
+            journal.record(res.min, res.max, res.value)
+    if journal:
+        # a shared ledger adds up what other participants counted as well
+        total = journal.total()
+    return total
+
+
+def find_null_cells(queues, rsettings, journal=None, print_keys=False):
+    """Scan table looking for 'Null' values in 'rsettings.value_column'.
+
+    Having 'Null' cells in Cassandra is the same as not having them.
+    However if you don't control the data model or cannot change it
+    for whatever reason but still want to know
+    how many such 'Null' cells you have, you are bit out of luck.
+    Filtering by 'Null' is not something that you can do in Cassandra.
+    So what you can do is to query them and look for 'Null' in the result.
+
+    Workers select only the keys and the column, and count the nulls
+    split by split. With 'print_keys' they send keys of the null rows
+    instead, and those are printed.
+    """
+    columns = key_columns(rsettings) + [rsettings.value_column]
+    if print_keys:
+        nulls = 0
+        for batch in get_rows(queues, rsettings, journal, columns=columns, parser=null_key_parser):
+            for row in batch.value:
+                print(Result(batch.min, batch.max, row))
+            nulls += len(batch.value)
+    else:
+        nulls = get_rows_count(queues, rsettings, journal, sql_statement=select_statement(rsettings, columns),
+                               parser=null_count_parser)
+    print("Found {} null cells in {keyspace}.{table}.{column}".format(
+        nulls, keyspace=rsettings.keyspace, table=rsettings.table, column=rsettings.value_column))
+    return nulls
+
+
+def export_rows(queues, rsettings, manifest, journal=None):
+    """Let workers write rows to their shards and record finished splits in the manifest.
+
+    Workers only report which shard got how many rows of a split, so rows
+    never go through the results queue. Returns the number of rows exported.
+    """
+    columns = key_columns(rsettings) + value_columns(rsettings) if rsettings.value_column else None
+    mt = Mapper_task(select_statement(rsettings, columns), rsettings.key, rsettings.filter_string)
+    mt.task_type = "export"
+    queues.mapper_queue.put(mt)
+    split_shards = {}
+    for res in consume_results(queues, rsettings, journal):
+        split = (res.min, res.max)
+        shards = split_shards.setdefault(split, {})
+        for (shard, rows) in res.value:
+            if shard is not None:
+                shards[shard] = shards.get(shard, 0) + rows
+        if res.complete:
+            queues.stats.add("results_consumed")
+            split_shards.pop(split)
+            for (shard, rows) in shards.items():
+                manifest.add(shard, res.min, res.max, rows)
+            if journal:
+                journal.record(res.min, res.max, sum(shards.values()))
+    manifest.write()
+    return manifest.rows()
+
+
+def print_export(queues, rsettings, manifest, journal=None):
+    rows = export_rows(queues, rsettings, manifest, journal)
+    print("Exported {} rows of {}.{} to {} shards, see {}".format(
+        rows, rsettings.keyspace, rsettings.table, len(manifest.shards), manifest.path))
+
+
+def print_rows(queues, rsettings, journal=None):
+    for batch in get_rows(queues, rsettings, journal):
+        for row in batch.value:
+            print(Result(batch.min, batch.max, row))
+
+
+def find_wide_partitions(rsettings, top=settings.wide_partitions_top):
+    """Find the token ranges, and in the end partitions, with the most rows.
+
+    First the whole table is counted split by split and the 'top' splits
+    with the most rows are kept. Then, level by level, these splits are
+    counted again with smaller and smaller split size, until splits cover
+    single tokens, that is single partitions. All hot splits of a level
+    are counted in parallel, in one run of the pipeline.
+    Returns a list of (count, (min, max)) tuples, most loaded first.
+    """
+    level_settings = copy.copy(rsettings)
+    hottest = []
+    level = 0
     while True:
-        if queues.results_queue.empty():
-            logging.debug("Waiting on results...")
-            logging.debug("Total so far: {}".format(total))
-            time.sleep(5)
-        else:
-            res = queues.results_queue.get()
-            if res is False:
-                # kill pill received
-                # end the loop and present the results
-                break
-            queues.stats_queue_results_consumed.put(0)
-            total += res.value
-    # send kill signal to process manager to stop all workers
-    queues.kill.set()
-    time.sleep(4) # wait for the kill event to reach all processes
+        logging.info("Counting rows in {} token ranges with split size {}".format(
+            len(level_settings.split_ranges), level_settings.split))
+        top_splits = TopK(top)
+        queues = Queues()
+        pm = multiprocessing.Process(target=process_manager, args=(queues, level_settings))
+        pm.start()
+        for res in get_split_counts(queues, level_settings):
+            top_splits.add(res.value, (res.min, res.max))
+        pm.join()
+
+        hottest = [(c, split) for (c, split) in top_splits.items() if c > 0]
+        print("Level {}, split size 10^{}:".format(level, level_settings.split))
+        failed = queues.stats.get("failed")
+        if failed:
+            print("    Incomplete, {} splits failed".format(failed))
+        for (c, (split_min, split_max)) in hottest:
+            print("    {} rows in token range {} - {}".format(c, split_min, split_max))
+        if level_settings.split == 0 or not hottest:
+            break
+        level += 1
+        level_settings.split = max(0, level_settings.split - settings.wide_partitions_level_step)
+        level_settings.split_ranges = sorted(split for (c, split) in hottest)
+    return hottest
+
+
+def print_wide_partitions(rsettings, top=settings.wide_partitions_top):
+    hottest = find_wide_partitions(rsettings, top)
+    if rsettings.extra_key:
+        token_columns = "{}, {}".format(rsettings.key, rsettings.extra_key)
+    else:
+        token_columns = rsettings.key
+    print("Widest partitions in {keyspace}.{table}:".format(keyspace=rsettings.keyspace, table=rsettings.table))
+    for (c, (split_min, split_max)) in hottest:
+        print("{} rows in partition with token {}, see: select {} from {}.{} where token({}) = {} limit 1".format(
+            c, split_min, token_columns, rsettings.keyspace, rsettings.table, token_columns, split_min))
+
+
+def approximate_count(queues, rsettings, error, time_budget=None):
+    """Estimate row count from splits counted in random order.
+
+    Workers take splits from a shuffled split plan. Once the confidence
+    interval is within 'error' share of the estimate, or 'time_budget'
+    seconds have passed, no new splits are handed out. Splits already
+    taken are still counted, so slow (large) splits are not left out of
+    the sample. Returns a SampleEstimator.
+    """
+    plan = rsettings.split_plan
+    tokens = sum(r_max - r_min for (r_min, r_max) in rsettings.split_ranges)
+    splits = split_predicter(rsettings.tr, rsettings.split, rsettings.split_ranges)
+    estimator = SampleEstimator(tokens, splits, settings.approximate_z)
+    started = time.time()
+    stopped = False
+
+    def stop(reason):
+        nonlocal stopped
+        logging.info("{}, finishing splits in flight".format(reason))
+        plan.stop()
+        stopped = True
+
+    def check_time_budget():
+        # also checked while waiting for results, slow splits may not finish before the budget is used up
+        if not stopped and time_budget is not None and time.time() - started >= time_budget:
+            stop("Time budget of {}s is used up".format(time_budget))
+
+    for res in get_split_counts(queues, rsettings, idle=check_time_budget):
+        estimator.add(res.value, res.max - res.min)
+        if not stopped and estimator.good_enough(error, settings.approximate_min_splits):
+            stop("Estimate is within {:.2%} after {} splits".format(error, estimator.samples))
+        check_time_budget()
+    return estimator
+
+
+def print_approximate_count(queues, rsettings, error, time_budget=None):
+    estimator = approximate_count(queues, rsettings, error, time_budget)
+    estimate = estimator.estimate()
+    margin = estimator.margin()
+    print("Estimated amount of rows in {keyspace}.{table} is {count} +- {margin} ({share:.2%}), "
+          "counted {samples} of {splits} splits".format(
+              keyspace=rsettings.keyspace, table=rsettings.table, count=round(estimate), margin=round(margin),
+              share=margin / estimate if estimate else 0, samples=estimator.samples, splits=estimator.splits))
+
+
+def count_distinct(queues, rsettings):
+    """Count distinct values of the value columns, combinations of them if there are more.
+
+    Workers count the values of every split with a DistinctCounter, which
+    keeps memory bounded with a HyperLogLog sketch, and the counters are
+    merged here. Null values are not counted. Returns the merged DistinctCounter.
+    """
+    columns = value_columns(rsettings)
+    # partition keys can be read once per partition
+    distinct = columns == key_columns(rsettings)
+    mt = Mapper_task(select_statement(rsettings, columns, distinct), rsettings.key, rsettings.filter_string)
+    mt.parser = distinct_value_parser
+    mt.task_type = "distinct"
+    queues.mapper_queue.put(mt)
+    total = DistinctCounter()
+    for res in consume_results(queues, rsettings):
+        for counter in res.value:
+            total.merge(counter)
+        queues.stats.add("results_consumed")
     return total
 
-    # now, chill and wait for results
-    #
-    #
-    #  this was needed for wide partition finder, the count per partition
-    #
-    #
-    # unaggregated_count = []
-    # while result.qsize() > 0:
-    #     r = result.get()
-    #     if aggregate:
-    #         count += r.value[0].count
-    #     else:
-    #         split_count = Result(r.min, r.max, r.value[0])
-    #         unaggregated_count.append(split_count)
-    # if aggregate:
-    #     return count
-    # else:
-    #     return unaggregated_count
-
-
-def print_rows(queues, rsettings):
-    for row in get_rows(queues, rsettings):
-        print(row)
-
-
-def find_wide_partitions(session,
-                         keyspace,
-                         table,
-                         key,
-                         split,
-                         value_column=None,
-                         filter_string=None):
-    # select count(*) from everywhere, record all the split sizes
-    # get back a list of dictionaries [ {'min': 123, 'max',124, 'count':1 } ]
-    # sort it by 'count' and show top 5 or something
-
-    # get rows count, but don't aggregate
-    count = get_rows_count(session, keyspace, table, key, split, filter_string,
-                           False)
-    # now we have count of rows per split, let's sort it
-    count.sort(key=lambda x: x.value, reverse=True)
-    # now that we know the most highly loaded splits, we can drill down
-    most_loaded_split = count[0]
-    token_range = Token_range(most_loaded_split.min, most_loaded_split.max)
-    most_loaded_split_count = get_rows_count(session,
-                                             keyspace,
-                                             table,
-                                             key,
-                                             split=14,
-                                             filter_string=None,
-                                             aggregate=False,
-                                             token_range=token_range)
-    most_loaded_split_count.sort(key=lambda x: x.value, reverse=True)
-
-    token_range = Token_range(most_loaded_split_count[0].min,
-                              most_loaded_split_count[0].max)
-
-    most_loaded_split_count2 = get_rows_count(session,
-                                              keyspace,
-                                              table,
-                                              key,
-                                              split=12,
-                                              filter_string=None,
-                                              aggregate=False,
-                                              token_range=token_range)
-    most_loaded_split_count2.sort(key=lambda x: x.value, reverse=True)
-
-    token_range = Token_range(most_loaded_split_count2[0].min,
-                              most_loaded_split_count2[0].max)
-
-    most_loaded_split_count3 = get_rows_count(session,
-                                              keyspace,
-                                              table,
-                                              key,
-                                              split=10,
-                                              filter_string=None,
-                                              aggregate=False,
-                                              token_range=token_range)
-    most_loaded_split_count3.sort(key=lambda x: x.value, reverse=True)
-
-    # narrow it down to 100 million split size
-    token_range = Token_range(most_loaded_split_count3[0].min,
-                              most_loaded_split_count3[0].max)
-
-    most_loaded_split_count4 = get_rows_count(session,
-                                              keyspace,
-                                              table,
-                                              key,
-                                              split=8,
-                                              filter_string=None,
-                                              aggregate=False,
-                                              token_range=token_range)
-    most_loaded_split_count4.sort(key=lambda x: x.value, reverse=True)
-
-    # narrow it down to 1 million split size
-    token_range = Token_range(most_loaded_split_count4[0].min,
-                              most_loaded_split_count4[0].max)
-
-    most_loaded_split_count5 = get_rows_count(session,
-                                              keyspace,
-                                              table,
-                                              key,
-                                              split=6,
-                                              filter_string=None,
-                                              aggregate=False,
-                                              token_range=token_range)
-    most_loaded_split_count5.sort(key=lambda x: x.value, reverse=True)
-
-    # narrow it down to 1 thousand split size
-    token_range = Token_range(most_loaded_split_count5[0].min,
-                              most_loaded_split_count5[0].max)
-
-    most_loaded_split_count6 = get_rows_count(session,
-                                              keyspace,
-                                              table,
-                                              key,
-                                              split=3,
-                                              filter_string=None,
-                                              aggregate=False,
-                                              token_range=token_range)
-    most_loaded_split_count6.sort(key=lambda x: x.value, reverse=True)
-
-    # narrow it down to 10 split size
-    token_range = Token_range(most_loaded_split_count6[0].min,
-                              most_loaded_split_count6[0].max)
-
-    most_loaded_split_count7 = get_rows_count(session,
-                                              keyspace,
-                                              table,
-                                              key,
-                                              split=1,
-                                              filter_string=None,
-                                              aggregate=False,
-                                              token_range=token_range)
-    most_loaded_split_count7.sort(key=lambda x: x.value, reverse=True)
-
-    print(most_loaded_split)
-    print(most_loaded_split_count[0])
-    print(most_loaded_split_count2[0])
-    print(most_loaded_split_count3[0])
-    print(most_loaded_split_count4[0])  # 100 million precision
-    print(most_loaded_split_count5[0])  # 1 million precision
-    print(most_loaded_split_count6[0])  # 1 thousand precision
-    print(most_loaded_split_count7[0])  # 10 precision
-
-    # .......
-
-
-def print_rows_count(queues, rsettings):
-    count = get_rows_count(queues, rsettings)
+
+def print_distinct_count(queues, rsettings):
+    total = count_distinct(queues, rsettings)
+    if total.exact:
+        accuracy = "exact"
+    else:
+        accuracy = "estimated, standard error {:.1%}".format(total.hll.error())
+    print("Amount of distinct values of {columns} in {keyspace}.{table} is {count} ({accuracy})".format(
+        columns=rsettings.value_column, keyspace=rsettings.keyspace, table=rsettings.table,
+        count=total.count(), accuracy=accuracy))
+
+
+def print_rows_count(queues, rsettings, journal=None):
+    count = get_rows_count(queues, rsettings, journal)
     print("Total amount of rows in {keyspace}.{table} is {count}".format(
         keyspace=rsettings.keyspace, table=rsettings.table, count=count))
 
@@ -803,7 +963,7 @@ def queue_monitor(queues, rsettings):
         logging.debug("Map queue full: {} empty: {}".format(queues.mapper_queue.full(), queues.mapper_queue.empty()))
         logging.debug("Worker queue full: {} empty: {}".format(queues.worker_queue.full(), queues.worker_queue.empty()))
         logging.debug("Results queue full: {} empty: {}".format(queues.results_queue.full(), queues.results_queue.empty()))
-        time.sleep(5)
+        queues.kill.wait(5)
     else:
         logging.debug("Queue monitor exiting.")
 
@@ -817,19 +977,29 @@ def process_manager(queues, rsettings):
     smon_process = multiprocessing.Process(target=stats_monitor, args=(queues, rsettings))
     smon_process.start()
 
-    # start splitter
-    splitter_process = multiprocessing.Process(target=splitter, args=(queues, rsettings))
-    splitter_process.start()
+    if rsettings.metrics_port or rsettings.metrics_file:
+        metrics_process = multiprocessing.Process(target=metrics_server, args=(queues, rsettings))
+        metrics_process.start()
+
+    if rsettings.trace_file:
+        trace_process = multiprocessing.Process(target=trace_writer, args=(queues, rsettings))
+        trace_process.start()
+
+    if rsettings.adaptive:
+        splitter_process = multiprocessing.Process(target=adaptive_splitter, args=(queues, rsettings))
+        splitter_process.start()
+    elif rsettings.ledger_path:
+        splitter_process = multiprocessing.Process(target=ledger_splitter, args=(queues, rsettings))
+        splitter_process.start()
+    elif rsettings.split_plan is None:
+        # workers claim splits from the plan themselves
+        rsettings.split_plan = SplitPlan(rsettings.split_ranges, pow(10, rsettings.split))
+        logging.info("Prepared {} with split size {}".format(rsettings.split_plan, rsettings.split))
 
     # mapper
     mapper_process = multiprocessing.Process(target=mapper, args=(queues,rsettings))
     mapper_process.start()
 
-    # TODO: remove this, as reducer is not used
-    # reducer
-    #reducer_process = multiprocessing.Process(target=reducer, args=(queues,rsettings))
-    #reducer_process.start()
-
     workers = []
     for w in range(rsettings.workers):
         # workers
@@ -838,52 +1008,570 @@ def process_manager(queues, rsettings):
         workers.append(worker_process)
 
     while not queues.kill.is_set():
-        for w in workers:
-            if not w.is_alive():
-                logging.warning("Process {} died.".format(w))
-                workers.remove(w)
-                time.sleep(1)
-                logging.warning("Starting a new process")
-                worker_process = multiprocessing.Process(target=cassandra_worker, args=(queues, rsettings))
-                worker_process.start()
-                workers.append(worker_process)
-        time.sleep(1)
+        # wake up as soon as any of the workers exits
+        multiprocessing.connection.wait([w.sentinel for w in workers], timeout=1)
+        for w in list(workers):
+            if w.is_alive():
+                continue
+            workers.remove(w)
+            if w.exitcode == 0:
+                # worker received kill pill and finished its work
+                logging.debug("Worker {} finished.".format(w))
+                continue
+            logging.warning("Process {} died.".format(w))
+            logging.warning("Starting a new process")
+            worker_process = multiprocessing.Process(target=cassandra_worker, args=(queues, rsettings))
+            worker_process.start()
+            workers.append(worker_process)
+        if not workers:
+            logging.debug("All workers finished. Process manager is stopping.")
+            break
     else:
         logging.debug("Global kill event! Process manager is stopping.")
 
-def reducer2(queues, rsettings):
-    """Filter out the relevant information from Cassandra results"""
+def count_result_parser(row, rsettings=None):
+    return row.count
 
-    pid = os.getpid()
-    print("Reducer started")
-    while True:
-        # wait for work
-        if queues.reducer_queue.empty():
-            logging.debug("Reducer {} waiting for work".format(pid))
-            time.sleep(2)
-        else:
-            result = queues.reducer_queue.get()
-            logging.debug("Got task {} from reducer queue".format(result))
-            for row in result.value:
-                queues.results_queue.put(row)
 
-def utc_time(value):
-    if isinstance(value, datetime.datetime):
-        value = value.replace(tzinfo=datetime.timezone.utc)
-    return value
+def null_count_parser(row, rsettings):
+    return 1 if getattr(row, rsettings.value_column) is None else 0
+
+
+def null_key_parser(row, rsettings):
+    """Return keys of the row if the value column is null, None otherwise."""
+    if getattr(row, rsettings.value_column) is not None:
+        return None
+    return dict((c, getattr(row, c)) for c in key_columns(rsettings))
+
+
+def distinct_value_parser(row, rsettings):
+    """Return value of the only value column, tuple of them if there are more, None if they are all null."""
+    values = tuple(getattr(row, column) for column in value_columns(rsettings))
+    if all(v is None for v in values):
+        return None
+    if len(values) == 1:
+        return values[0]
+    return values
 
-def count_result_parser(row, rsettings=None):
-    return row.count
 
 def get_result_parser(row, rsettings=None):
     results_that_we_care_about = {}
     results_that_we_care_about[rsettings.key] = getattr(row, rsettings.key)
-    results_that_we_care_about[rsettings.extra_key] = getattr(row, rsettings.extra_key)
+    if rsettings.extra_key:
+        results_that_we_care_about[rsettings.extra_key] = getattr(row, rsettings.extra_key)
+    for column in value_columns(rsettings):
+        results_that_we_care_about[column] = getattr(row, column)
 
     return results_that_we_care_about
 
+def get_prepared(session, sql, prepared_statements):
+    """Return prepared statement for the CQL, preparing it once per session."""
+    prepared = prepared_statements.get(sql)
+    if prepared is None:
+        logging.debug("Preparing statement: {}".format(sql))
+        prepared = session.prepare(sql)
+        prepared_statements[sql] = prepared
+    return prepared
+
+
+def throttle(rsettings):
+    """Wait until the rate limiter allows the next query, if one is used."""
+    if rsettings.rate_limiter:
+        rsettings.rate_limiter.acquire()
+
+
+def report_latency(queues, rsettings, latency, future=None):
+    """Let the rate limiter and metrics know how long a query took.
+
+    The host in latency metrics is the coordinator of the query's response future.
+    """
+    if rsettings.rate_limiter:
+        rsettings.rate_limiter.feedback(latency)
+    if rsettings.metrics_port or rsettings.metrics_file:
+        host = getattr(future, "coordinator_host", None) or "unknown"
+        queues.stats.observe(str(host), latency)
+
+
+def record_page(task, future, queues, rsettings):
+    """Report latency of the task's last page and add it to the task's timings."""
+    latency = time.time() - task.page_started
+    report_latency(queues, rsettings, latency, future)
+    task.execute_time += latency
+    task.pages += 1
+    host = getattr(future, "coordinator_host", None)
+    if host is not None:
+        task.host = str(host)
+
+
+def trace_task(task, queues, rsettings, failed=False):
+    if rsettings.trace_file:
+        queues.trace_queue.put(trace_record(task, time.time(), failed))
+
+
+def write_rows(session, task, rows, prepared_statements, queues, rsettings):
+    """Execute task's write statement (update) for every row, by its primary key."""
+    # primary key is looked up by the main process before workers start
+    columns = sum(get_primary_key(rsettings), [])
+    sql = "{} where {}".format(task.write_sql, key_conditions(columns))
+    statement = get_prepared(session, sql, prepared_statements)
+    execute_writes(session, (statement.bind(task.write_values + [getattr(row, c) for c in columns]) for row in rows),
+                   queues, rsettings)
+    queues.stats.add("updated", len(rows))
+
+
+def primary_key_columns(session, rsettings):
+    """Return names of partition key and clustering columns of the table.
+
+    They are taken from the cluster metadata. If the table is not found there,
+    key and extra key are used as the partition key, like in token ranges.
+    """
+    keyspace = session.cluster.metadata.keyspaces.get(rsettings.keyspace)
+    table = keyspace.tables.get(rsettings.table) if keyspace else None
+    if table is None:
+        logging.warning("Table {}.{} not found in cluster metadata".format(rsettings.keyspace, rsettings.table))
+        return key_columns(rsettings), []
+    return [c.name for c in table.partition_key], [c.name for c in table.clustering_key]
+
+
+def key_conditions(columns):
+    return " and ".join("{} = ?".format(c) for c in columns)
+
+
+def delete_sql(rsettings, columns):
+    return "delete from {keyspace}.{table} where {conditions}".format(
+        keyspace=rsettings.keyspace, table=rsettings.table, conditions=key_conditions(columns))
+
+
+def delete_statements(session, rows, prepared_statements, rsettings):
+    """Generator of statements that delete the rows, grouped by partition.
+
+    When no filter is used, every row of a partition matches, so the whole
+    partition is deleted with one statement. Otherwise matching rows of a
+    partition are deleted with unlogged batches of up to
+    'settings.delete_batch_size' row deletes. Rows of a split are ordered
+    by token, so rows of the same partition come one after another.
+    """
+    (partition_columns, clustering_columns) = get_primary_key(rsettings)
+    whole_partitions = not rsettings.filter_string or not clustering_columns
+    if whole_partitions:
+        statement = get_prepared(session, delete_sql(rsettings, partition_columns), prepared_statements)
+    else:
+        statement = get_prepared(session, delete_sql(rsettings, partition_columns + clustering_columns),
+                                 prepared_statements)
+
+    def partition_key(row):
+        return [getattr(row, c) for c in partition_columns]
+
+    for (key, partition_rows) in itertools.groupby(rows, partition_key):
+        if whole_partitions:
+            yield statement.bind(key)
+            continue
+        partition_rows = list(partition_rows)
+        for i in range(0, len(partition_rows), settings.delete_batch_size):
+            chunk = partition_rows[i:i + settings.delete_batch_size]
+            if len(chunk) == 1:
+                yield statement.bind(key + [getattr(chunk[0], c) for c in clustering_columns])
+                continue
+            batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+            for row in chunk:
+                batch.add(statement.bind(key + [getattr(row, c) for c in clustering_columns]))
+            yield batch
+
+
+def execute_writes(session, statements, queues, rsettings):
+    """Execute statements asynchronously, up to 'settings.write_concurrency' at a time.
+
+    Returns once all of them are done, raises the first error.
+    """
+    in_flight = collections.deque()
+    for statement in statements:
+        if len(in_flight) >= settings.write_concurrency:
+            wait_write(in_flight.popleft(), queues, rsettings)
+        throttle(rsettings)
+        in_flight.append((session.execute_async(statement), time.time()))
+    while in_flight:
+        wait_write(in_flight.popleft(), queues, rsettings)
+
+
+def wait_write(write, queues, rsettings):
+    (future, started) = write
+    future.result()
+    report_latency(queues, rsettings, time.time() - started, future)
+
+
+def delete_page(session, rows, prepared_statements, queues, rsettings):
+    """Delete rows of a page before they are sent to the results queue."""
+    execute_writes(session, delete_statements(session, rows, prepared_statements, rsettings), queues, rsettings)
+    queues.stats.add("deleted_partitions" if deletes_partitions(rsettings) else "deleted", len(rows))
+
+
+def send_batch(task, batch, last, queues):
+    res = Result(task.split_min, task.split_max, batch, complete=last)
+    logging.debug(res)
+    queues.results_queue.put(res)
+
+
+def process_page(session, task, page, last, prepared_statements, queues, rsettings):
+    """Parse rows of a page and put them in the results queue.
+
+    Rows are sent in batches, one Result per page. Pages with more than
+    'settings.result_batch_size' rows are sent in several batches.
+    Only the batch with the last page of a split is marked as complete.
+    Rows of delete tasks are deleted and tasks with 'write_sql' execute it
+    for every row, then only the number of rows is sent. Rows of export tasks
+    are written to the worker's shard, distinct tasks send one counter
+    with the last page.
+    """
+    if rsettings.trace_file:
+        task.bytes += estimate_size(page)
+    page_rows = 0
+    batch = []
+    if task.task_type == "delete" or task.write_sql:
+        # rows are deleted or updated right away, only their count is sent
+        if task.task_type == "delete":
+            delete_page(session, page, prepared_statements, queues, rsettings)
+        else:
+            write_rows(session, task, page, prepared_statements, queues, rsettings)
+        page_rows = len(page)
+        send_batch(task, [page_rows], last, queues)
+    elif task.task_type == "count":
+        # counts are added up, one number is sent per page
+        page_rows = sum(task.parser(row, rsettings) for row in page)
+        send_batch(task, [page_rows], last, queues)
+    elif task.task_type == "distinct":
+        # values are added to the split's counter, which is sent with the last page
+        page_rows = len(page)
+        if task.distinct is None:
+            task.distinct = DistinctCounter(settings.distinct_split_limit)
+        for row in page:
+            value = task.parser(row, rsettings)
+            if value is not None:
+                task.distinct.add(value)
+        if last:
+            send_batch(task, [task.distinct], last, queues)
+    elif task.task_type == "export":
+        # rows go straight to the worker's shard, only their count is sent
+        page_rows = len(page)
+        shard = rsettings.exporter.write(page, flush=last)
+        send_batch(task, [(shard, page_rows)], last, queues)
+    else:
+        for row in page:
+            page_rows += 1
+            if task.parser:
+                row = task.parser(row, rsettings)
+                if row is None:
+                    continue
+            batch.append(row)
+            if len(batch) >= settings.result_batch_size:
+                send_batch(task, batch, False, queues)
+                batch = []
+        if batch or last:
+            send_batch(task, batch, last, queues)
+    task.rows += page_rows
+    queues.stats.add("rows", page_rows)
+    if last:
+        queues.stats.add("results")
+        queues.stats.add("tokens", task.split_max - task.split_min)
+        trace_task(task, queues, rsettings)
+        if rsettings.adaptive:
+            queues.feedback_queue.put(SplitFeedback(task.split_min, task.split_max, task.rows,
+                                                    time.time() - task.started))
+
+
+def report_task_failure(task, queues, rsettings):
+    if rsettings.adaptive:
+        # let the splitter know, so that the split gets retried
+        queues.feedback_queue.put(SplitFeedback(task.split_min, task.split_max, task.rows,
+                                                time.time() - task.started, failed=True))
+
+
+def requeue_task(task, queues, rsettings, pending=None):
+    """Put a failed task aside, to be continued from its last page.
+
+    Workers that keep running put the task in their own 'pending' list,
+    workers that are about to exit put it in the retry queue, where it is
+    picked up before any new work. Tasks that have failed
+    'settings.task_max_attempts' times are given up on.
+    """
+    task.attempts += 1
+    task.retries = 0
+    if task.attempts >= settings.task_max_attempts:
+        logging.error("Giving up on split {} {} after {} attempts".format(task.split_min, task.split_max, task.attempts))
+        trace_task(task, queues, rsettings, failed=True)
+        if task.paging_state is None and rsettings.adaptive:
+            # adaptive splitter retries the split, and counts it as failed when it gives up too
+            report_task_failure(task, queues, rsettings)
+            return
+        queues.stats.add("failed")
+        if rsettings.ledger_path:
+            # main marks the chunk of the split as failed in the ledger
+            queues.results_queue.put(Result(task.split_min, task.split_max, None, failed=True))
+        if rsettings.adaptive:
+            # some pages have already been processed, retrying would duplicate them
+            queues.feedback_queue.put(SplitFeedback(task.split_min, task.split_max, task.rows,
+                                                    time.time() - task.started))
+        return
+    logging.warning("Will retry split {} {} later".format(task.split_min, task.split_max))
+    queues.stats.add("requeued")
+    if pending is None:
+        queues.retry_queue.put(task)
+    else:
+        retry_later(task, pending, task.attempts * settings.requeue_delay)
+
+
+def retry_later(task, pending, delay):
+    """Put the task in the 'pending' list, which is kept in the order tasks are due to be retried."""
+    task.due = time.time() + delay
+    i = len(pending)
+    while i > 0 and pending[i - 1].due > task.due:
+        i -= 1
+    pending.insert(i, task)
+
+
+def retry_failed_page(task, error, queues, rsettings, pending=None):
+    """Decide what to do with a page that failed.
+
+    Returns True if the page should be retried right away. Otherwise
+    the task is either handed back to the splitter (adaptive mode, nothing
+    read yet), then None is returned, or put aside to be retried later
+    and False is returned.
+    """
+    logging.warning("Got Cassandra exception: {msg} when running query: {sql}".format(msg=error, sql=task.sql))
+    queues.stats.add("errors")
+    if rsettings.rate_limiter:
+        rsettings.rate_limiter.feedback(error=True)
+    if rsettings.adaptive and task.paging_state is None:
+        # adaptive splitter will cut the split in smaller pieces
+        trace_task(task, queues, rsettings, failed=True)
+        report_task_failure(task, queues, rsettings)
+        return None
+    task.retries += 1
+    if task.retries <= settings.page_retries:
+        queues.stats.add("retries")
+        return True
+    requeue_task(task, queues, rsettings, pending)
+    return False
+
+
+def task_statement(session, task, prepared_statements, rsettings):
+    """Return statement for the task, with parameters bound and fetch size set.
+
+    Tasks with parameters are prepared once per session and the prepared
+    statement is reused for all the following tasks with the same CQL.
+    """
+    if task.parameters is None:
+        return SimpleStatement(task.sql, fetch_size=rsettings.fetch_size)
+    statement = get_prepared(session, task.sql, prepared_statements).bind(task.parameters)
+    statement.fetch_size = rsettings.fetch_size
+    return statement
+
+
+def run_task(session, task, prepared_statements, queues, rsettings, router=None):
+    """Execute the task page by page, recording the paging state after each page.
+
+    A failed page is retried from the last paging state, so pages already
+    read are not read again. Returns True if the task is finished, False if
+    it could not be finished and None if it was handed back to the adaptive
+    splitter, which is not a failure of the worker.
+    With a router every page is sent to a replica of the split.
+    """
+    if task.started is None:
+        task.started = time.time()
+    while True:
+        try:
+            statement = task_statement(session, task, prepared_statements, rsettings)
+            throttle(rsettings)
+            task.page_started = time.time()
+            rs = session.execute(statement, paging_state=task.paging_state, host=task_host(router, task))
+            record_page(task, rs.response_future, queues, rsettings)
+            process_page(session, task, rs.current_rows, not rs.paging_state, prepared_statements, queues, rsettings)
+        except Exception as e:
+            retry = retry_failed_page(task, e, queues, rsettings)
+            if retry:
+                time.sleep(task.retries)
+                continue
+            return retry
+        task.retries = 0
+        task.paging_state = rs.paging_state
+        if not task.paging_state:
+            return True
+
+
+def task_host(router, task):
+    """Return the host to send the task to, None lets the driver pick it."""
+    if router is None:
+        return None
+    return router.host(task.split_min)
+
+
+def execute_async_page(session, task, completed, prepared_statements, rsettings, router=None):
+    """Start fetching the next page of the task and put it in 'completed' queue when done.
+
+    Callbacks run in the driver's event loop thread, so they only signal
+    completion and leave the processing of results to the worker.
+    """
+    if task.started is None:
+        task.started = time.time()
+    statement = task_statement(session, task, prepared_statements, rsettings)
+    throttle(rsettings)
+    task.page_started = time.time()
+    future = session.execute_async(statement, paging_state=task.paging_state, host=task_host(router, task))
+    future.add_callbacks(lambda rows: completed.put((task, future, None)),
+                         lambda e: completed.put((task, future, e)))
+
+
+def new_task(queues, rsettings, control, timeout):
+    """Return next task from the split plan or the worker queue, False when there is no more work.
+
+    Raises queue.Empty if the worker queue stays empty for 'timeout' seconds.
+    """
+    if control.job is None:
+        return queues.worker_queue.get(True, timeout)
+    index = control.next_split(rsettings.split_plan, rsettings.workers * rsettings.threads)
+    if index is None:
+        return False
+    queues.stats.add("splits")
+    queues.stats.add("mapper")
+    return control.job.task(rsettings.split_plan.split(index))
+
+
+def wait_for_job(queues):
+    """Return the SplitPlanJob sent by the mapper, None if the run is stopped first."""
+    while not queues.kill.is_set():
+        try:
+            return queues.worker_queue.get(True, 1)
+        except queue.Empty:
+            continue
+    return None
+
+
+def next_task(queues, pending):
+    """Return a task that has to be retried, if there is one that is due."""
+    if pending and pending[0].due <= time.time():
+        return pending.pop(0)
+    try:
+        return queues.retry_queue.get_nowait()
+    except queue.Empty:
+        return None
+
+
+def sync_worker_loop(session, queues, rsettings, router, control, prepared_statements):
+    """Run tasks from worker queue one at a time."""
+    pid = os.getpid()
+    while not queues.kill.is_set() and not control.stopping.is_set():
+        # tasks left by failed workers go first
+        task = next_task(queues, None)
+        if task is None:
+            try:
+                task = new_task(queues, rsettings, control, 1)
+            except queue.Empty:
+                logging.debug("Worker {} waiting for work".format(pid))
+                queues.stats.flush()
+                continue
+        if task is False:
+            control.kill_pill(queues)
+            return
+        logging.debug("Got task {} from worker queue".format(task))
+        if run_task(session, task, prepared_statements, queues, rsettings, router) is False:
+            logging.warning("Cassandra connection issues!")
+            control.fail()
+            return
+
+
+def async_worker_loop(session, queues, rsettings, router, control, prepared_statements):
+    """Run tasks from worker queue, keeping up to 'rsettings.concurrency' of them in flight."""
+    pid = os.getpid()
+    completed = queue.Queue()
+    pending = []
+    in_flight = 0
+    while not queues.kill.is_set():
+        # once the worker is stopping, only tasks in flight and tasks to retry are finished
+        draining = control.stopping.is_set()
+        # process finished pages, wait for one if there is no room for new tasks,
+        # but not past the time the next pending task is due
+        block = in_flight >= rsettings.concurrency or draining
+        timeout = 1
+        if pending and in_flight < rsettings.concurrency:
+            timeout = min(1, max(0, pending[0].due - time.time()))
+        while in_flight > 0:
+            try:
+                (task, future, error) = completed.get(block, timeout)
+            except queue.Empty:
+                break
+            block = False
+            if error is None:
+                record_page(task, future, queues, rsettings)
+                try:
+                    rs = future.result()
+                    process_page(session, task, rs.current_rows, not rs.paging_state, prepared_statements,
+                                 queues, rsettings)
+                    task.retries = 0
+                    task.paging_state = rs.paging_state
+                except Exception as e:
+                    error = e
+                else:
+                    if not task.paging_state:
+                        in_flight -= 1
+                        continue
+            if error is not None:
+                # failed page is retried after a while, like in sync_worker_loop, or the task is put aside
+                if retry_failed_page(task, error, queues, rsettings, pending):
+                    retry_later(task, pending, task.retries)
+                in_flight -= 1
+                continue
+            # fetch the next page
+            try:
+                execute_async_page(session, task, completed, prepared_statements, rsettings, router)
+            except Exception:
+                requeue_task(task, queues, rsettings, pending)
+                in_flight -= 1
+
+        if in_flight >= rsettings.concurrency:
+            continue
+
+        task = next_task(queues, pending)
+        if task is None:
+            if draining:
+                if in_flight == 0 and not pending:
+                    return
+                if in_flight == 0:
+                    time.sleep(min(1, max(0, pending[0].due - time.time())))
+                continue
+            try:
+                task = new_task(queues, rsettings, control, 0.1 if in_flight else 1)
+            except queue.Empty:
+                if not in_flight:
+                    logging.debug("Worker {} waiting for work".format(pid))
+                    queues.stats.flush()
+                continue
+            if task is False:
+                # kill pill received, finish tasks in flight first
+                control.kill_pill(queues)
+                continue
+        logging.debug("Got task {} from worker queue".format(task))
+        try:
+            execute_async_page(session, task, completed, prepared_statements, rsettings, router)
+        except Exception as e:
+            if retry_failed_page(task, e, queues, rsettings, pending):
+                retry_later(task, pending, task.retries)
+            continue
+        in_flight += 1
+    else:
+        logging.debug("Worker stopping due to kill event.")
+
+
 def cassandra_worker(queues, rsettings):
-    """Executes SQL statements and puts results in result queue"""
+    """Executes SQL statements and puts results in result queue.
+
+    Every worker process runs 'rsettings.threads' threads sharing one
+    session, each of them keeping up to 'rsettings.concurrency' queries in
+    flight. Processes add CPU for parsing rows, threads and concurrency
+    add I/O parallelism without more connections.
+
+    Worker exits when it gets a kill pill from the worker queue, after
+    passing it on to the results queue. On connection issues it exits with
+    an error, so that process manager starts a new one.
+    """
     cas_settings = rsettings.cas_settings
     pid = os.getpid()
     if "," in cas_settings.host:
@@ -895,82 +1583,111 @@ def cassandra_worker(queues, rsettings):
     # a bit of random delay
     if rsettings.worker_max_delay_on_startup > 0:
         time.sleep(random.choice(range(rsettings.worker_max_delay_on_startup)))
-    session = get_cassandra_session(host, cas_settings.port, cas_settings.user,
-                                    cas_settings.password, cas_settings.ssl_cert, cas_settings.ssl_key, cas_settings.dc, cas_settings.cacert,
-                                    cas_settings.ssl_v1 )
+    session = connect(cas_settings, host)
 
     sql = "use {}".format(rsettings.keyspace)
     logging.debug("Executing SQL: {}".format(sql))
     session.execute(sql)
-    if not session.is_shutdown:
-        logging.debug("Worker {} connected to Cassandra.".format(pid))
-        while not queues.kill.is_set():
-            # wait for work
-            if queues.worker_queue.empty():
-                logging.debug("Worker {} waiting for work".format(pid))
-                time.sleep(2)
-            else:
-                task = queues.worker_queue.get()
-                if task is False:
-                    # kill pill received
-                    # pass it to the results queue
-                    queues.results_queue.put(False)
-                    continue # and return back to waiting for work
-                logging.debug("Got task {} from worker queue".format(task))
-                try:
-                    r = session.execute(task.sql)
-                except:
-                    logging.warning("Cassandra connection issues!")
-                    return False
-                if task.task_type == "delete":
-                    queues.stats_queue_deleted.put(0)
-                    logging.debug("DELETE: {}".format(task.sql))
-                else:
-                    for row in r:
-                        logging.debug(row)
-                        if task.parser:
-                            row = task.parser(row, rsettings)
-                        res = Result(task.split_min, task.split_max, row)
-                        logging.debug(res)
-                        queues.results_queue.put(res)
-                        queues.stats_queue_results.put(0)
-        else:
+    if session.is_shutdown:
+        sys.exit(1)
+    logging.debug("Worker {} connected to Cassandra.".format(pid))
+    router = ReplicaRouter(session, rsettings.keyspace) if rsettings.token_aware else None
+
+    # all threads share the session, it is thread safe
+    control = WorkerControl()
+    if rsettings.split_plan is not None:
+        control.job = wait_for_job(queues)
+        if control.job is None:
             logging.debug("Worker stopping due to kill event.")
+            return
+    prepared_statements = {}
+    loop = async_worker_loop if rsettings.concurrency > 1 else sync_worker_loop
+    threads = [threading.Thread(target=loop, args=(session, queues, rsettings, router, control, prepared_statements))
+               for i in range(rsettings.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    queues.stats.flush()
+    if rsettings.exporter:
+        rsettings.exporter.close()
+    if control.failed:
+        if control.job is not None:
+            # splits claimed but not started are left for the other workers,
+            # and the new worker started by process manager needs the job as well
+            for index in control.unclaimed():
+                queues.retry_queue.put(control.job.task(rsettings.split_plan.split(index)))
+            queues.worker_queue.put(control.job)
+        elif control.pill:
+            # the new worker started by process manager has to get a kill pill as well
+            queues.worker_queue.put(False)
+        sys.exit(1)
+    if control.pill:
+        # all tasks are done, now pass the kill pill on
+        queues.results_queue.put(False)
+    else:
+        logging.debug("Worker stopping due to kill event.")
 
 
 def mapper(queues, rsettings):
-    """Prepares SQL statements for worker and puts tasks in worker queue"""
-    try:
-        map_task = queues.mapper_queue.get(True,10) # initially, wait for 5 sec to receive first work orders
-    except:
-        logging.warning("Mapper did not receive any work...timed out.")
-        return False
+    """Prepares SQL statements for workers.
+
+    With a split plan one SplitPlanJob is sent to every worker, otherwise
+    every split from the adaptive splitter is put in worker queue as a task.
+    """
+    # main process may take a while to look things up before it sends the work order
+    while True:
+        try:
+            map_task = queues.mapper_queue.get(True, 1)
+            break
+        except queue.Empty:
+            if queues.kill.is_set():
+                logging.warning("Mapper did not receive any work before the run was stopped.")
+                return False
 
     print("mapper Received work assignment::: {}".format(map_task.sql_statement))
 
-    while True:
-        if queues.split_queue.empty():
-            logging.debug("Split queue empty. Mapper is waiting")
-            time.sleep(1)
-        else:
-            split = queues.split_queue.get()
-            if split is False:
-                # this is a kill pill, no more work, let's relax
-                logging.debug("Mapper has received kill pill, passing it on to workers and exiting.")
-                queues.worker_queue.put(False) # pass the kill pill
-                return True
-
-            if rsettings.extra_key:
-                sql = "{statement} where token({key}, {extra_key}) >= {min} and token({key}, {extra_key}) < {max}".format(statement=map_task.sql_statement, key=map_task.key_column, extra_key=rsettings.extra_key, min=split[0], max=split[1])
-            else:
-                sql = "{statement} where token({key}) >= {min} and token({key}) < {max}".format(statement=map_task.sql_statement, key=map_task.key_column, min=split[0], max=split[1])
+    # token bounds are bound to a prepared statement by the workers,
+    # so the statement is the same for every split
+    if rsettings.extra_key:
+        token_columns = "{}, {}".format(map_task.key_column, rsettings.extra_key)
+    else:
+        token_columns = map_task.key_column
+    sql = "{statement} where token({columns}) >= ? and token({columns}) < ?".format(
+        statement=map_task.sql_statement, columns=token_columns)
+    if rsettings.filter_string:
+        sql = "{} and {}".format(sql, rsettings.filter_string)
+
+    if rsettings.split_plan is not None:
+        # workers build tasks for splits of the plan themselves, one job for every worker
+        job = SplitPlanJob(sql, map_task.parser, map_task.task_type, map_task.write_sql, map_task.write_values)
+        for w in range(rsettings.workers):
+            put_unless_killed(queues.worker_queue, job, queues.kill)
+        return True
 
-            if rsettings.filter_string:
-                sql = "{} and {}".format(sql, rsettings.filter_string)
-            t = CassandraWorkerTask(sql, split, map_task.parser)
-            queues.worker_queue.put(t)
-            queues.stats_queue_mapper.put(0)
-            logging.debug("Mapper prepared work task: {}".format(sql))
+    while not queues.kill.is_set():
+        try:
+            split = queues.split_queue.get(True, 1)
+        except queue.Empty:
+            logging.debug("Split queue empty. Mapper is waiting")
+            continue
+        if split is False:
+            # this is a kill pill, no more work, let's relax
+            logging.debug("Mapper has received kill pill, passing it on to workers and exiting.")
+            queues.stats.flush()
+            for w in range(rsettings.workers):
+                # one kill pill for every worker
+                put_unless_killed(queues.worker_queue, False, queues.kill)
+            return True
+
+        t = CassandraWorkerTask(sql, split, map_task.parser, parameters=split)
+        t.task_type = map_task.task_type
+        t.write_sql = map_task.write_sql
+        t.write_values = map_task.write_values
+        if not put_unless_killed(queues.worker_queue, t, queues.kill):
+            break
+        queues.stats.add("mapper")
+        logging.debug("Mapper prepared work task: {} {}".format(sql, split))
 
 
 
@@ -1042,34 +1759,138 @@ if __name__ == "__main__":
     rsettings.key = args.key
     rsettings.extra_key = args.extra_key
     rsettings.filter_string = args.filter_string
+    rsettings.value_column = args.value_column
     rsettings.tr = tr
     rsettings.cas_settings = cas_settings
+    rsettings.split_mode = args.split_mode
+    rsettings.ring_file = args.ring_file
+    rsettings.split_ranges = get_split_ranges(rsettings)
+    rsettings.adaptive = args.adaptive
     rsettings.workers = args.workers
+    rsettings.threads = args.threads
+    rsettings.concurrency = args.concurrency
+    rsettings.fetch_size = args.fetch_size
+    rsettings.token_aware = args.token_aware
+    rsettings.metrics_port = args.metrics_port
+    rsettings.metrics_file = args.metrics_file
+    rsettings.trace_file = args.trace
+    if args.max_rate:
+        rsettings.rate_limiter = RateLimiter(args.max_rate, args.min_rate, args.target_latency,
+                                             settings.rate_adjust_interval, settings.rate_increase,
+                                             settings.rate_decrease, settings.rate_slow_share, settings.rate_burst)
     if rsettings.workers > 10:
         # if more than 10 workers are used, we add delay to their startup logic
         rsettings.worker_max_delay_on_startup = rsettings.workers * 2
 
-    pm = multiprocessing.Process(target=process_manager, args=(queues, rsettings))
-    pm.start()
-
-    # TODO: needs re-implementation
-    if args.action == "find-nulls":
-        find_null_cells(args.keyspace, args.table, "id", "comment")
-    elif args.action == "count-rows":
-        print_rows_count(queues, rsettings)
-    elif args.action == "print-rows":
-        print_rows(queues, rsettings)
-    elif args.action == "delete-rows":
-        delete_rows(queues, rsettings)
-    # TODO: needs re-implementation
-    elif args.action == "find-wide-partitions":
-        find_wide_partitions(args.keyspace, args.table, args.key,
-                             args.split, args.value_column, args.filter_string)
-    # TODO: needs re-implementation
-    elif args.action == "update-rows":
-        update_rows(args.keyspace, args.table, args.key,
-                    args.update_key, args.update_value, args.split,
-                    args.filter_string, args.extra_key)
-    else:
-        # this won't be accepted by argparse anyways
-        sys.exit(1)
+    participant = None
+    if args.ledger:
+        participant = args.participant or default_participant()
+
+    manifest = None
+    if args.action == "export-rows":
+        os.makedirs(args.output_dir, exist_ok=True)
+        rsettings.exporter = ShardWriter(args.output_dir, args.format, args.gzip, participant)
+        manifest_job = {"keyspace": args.keyspace, "table": args.table, "format": args.format, "gzip": args.gzip}
+        if args.ledger:
+            # every participant lists its own shards
+            manifest = Manifest(args.output_dir, manifest_job, "manifest-{}.json".format(participant.replace(":", "-")))
+        else:
+            manifest = Manifest(args.output_dir, manifest_job)
+        if args.resume:
+            manifest.load()
+
+    update_value = None
+    if args.action == "update-rows":
+        try:
+            update_value = get_update_value(rsettings, args.update_key, args.update_value)
+        except ValueError as e:
+            logging.error("Can't set {} to {}: {}".format(args.update_key, args.update_value, e))
+            sys.exit(1)
+        if not confirm_update(rsettings, args.update_key, update_value):
+            sys.exit(1)
+
+    journal = None
+    if args.journal or args.ledger:
+        job = {"action": args.action, "keyspace": args.keyspace, "table": args.table, "key": args.key,
+               "extra_key": args.extra_key, "filter_string": args.filter_string,
+               "min_token": tr.min, "max_token": tr.max}
+        if args.action in ["find-nulls", "export-rows"]:
+            job["value_column"] = args.value_column
+        if args.action == "export-rows":
+            job["export"] = {"format": args.format, "gzip": args.gzip}
+        if args.action == "update-rows":
+            job["update"] = [update_sql(rsettings, args.update_key), args.update_value]
+    if args.ledger:
+        # participants must split the ring the same way
+        job["split"] = args.split
+        journal = Ledger(args.ledger, job, participant)
+        if not journal.open(rsettings.split_ranges, pow(10, rsettings.split)):
+            logging.error("Can't join ledger {}, it was created for a different job.".format(args.ledger))
+            sys.exit(1)
+        rsettings.ledger_path = args.ledger
+        rsettings.participant = journal.participant
+    elif args.journal:
+        journal = Journal(args.journal, job)
+        if not journal.open(args.resume):
+            logging.error("Can't resume from journal {}, it was written by a different job.".format(args.journal))
+            sys.exit(1)
+        if args.resume:
+            completed = journal.completed_ranges()
+            rsettings.split_ranges = subtract_ranges(rsettings.split_ranges, completed)
+            logging.info("Skipping {} finished splits, {} token ranges left to scan".format(
+                len(completed), len(rsettings.split_ranges)))
+
+    if args.approximate is not None:
+        # main process stops the plan once the estimate is good enough, splits are claimed
+        # one by one so that few of them are left to finish after that
+        rsettings.split_plan = SplitPlan(rsettings.split_ranges, pow(10, rsettings.split), max_chunk=1, shuffle=True)
+
+    if args.trace:
+        start_trace(args.trace)
+
+    if args.action in ["delete-rows", "update-rows"]:
+        # cluster metadata is slow to get, so it is not left for after the pipeline has started
+        get_primary_key(rsettings)
+
+    pm = None
+    if args.action != "find-wide-partitions":
+        # find-wide-partitions runs the pipeline once per level by itself
+        pm = multiprocessing.Process(target=process_manager, args=(queues, rsettings))
+        pm.start()
+
+    try:
+        if args.action == "find-nulls":
+            find_null_cells(queues, rsettings, journal, args.print_keys)
+        elif args.action == "count-rows" and args.approximate is not None:
+            print_approximate_count(queues, rsettings, args.approximate, args.time_budget)
+        elif args.action == "count-rows":
+            print_rows_count(queues, rsettings, journal)
+        elif args.action == "print-rows":
+            print_rows(queues, rsettings, journal)
+        elif args.action == "delete-rows":
+            delete_rows(queues, rsettings, journal)
+        elif args.action == "find-wide-partitions":
+            print_wide_partitions(rsettings, args.top)
+        elif args.action == "update-rows":
+            update_rows(queues, rsettings, args.update_key, update_value, journal)
+        elif args.action == "count-distinct":
+            print_distinct_count(queues, rsettings)
+        elif args.action == "export-rows":
+            print_export(queues, rsettings, manifest, journal)
+        else:
+            # this won't be accepted by argparse anyways
+            sys.exit(1)
+        if pm:
+            # trace writer is done and all counters are flushed once process manager exits
+            pm.join()
+        if args.trace:
+            print_trace_report(args.trace)
+        failed = queues.stats.get("failed")
+        if failed:
+            logging.error("Gave up on {} splits after too many failures, the result is incomplete".format(failed))
+            sys.exit(1)
+    finally:
+        # processes that are still waiting for work are stopped if we failed
+        queues.kill.set()
+        if journal:
+            journal.close()
@@ -3,9 +3,97 @@ default_max_token = 9223372036854775807
 split_q_size = 20000
 worker_q_size = 20000
 mapper_q_size = 20000
-reducer_q_size = 20000
 results_q_size = 20000
-stats_q_size = 20000
+# how often each process adds its event counts to the shared stats counters, seconds
+stats_flush_interval = 0.5
+feedback_q_size = 20000
+latency_q_size = 20000
+trace_q_size = 20000
+# max amount of rows sent from a worker in one results queue message
+result_batch_size = 5000
+# delete-rows: max row deletes in one unlogged batch, all of them in the same partition
+delete_batch_size = 100
+# how many write statements (deletes, batches) each worker keeps in flight
+write_concurrency = 32
+# rows per page when reading a split (--fetch-size)
+fetch_size = 5000
+# how many times a failed page is retried by the same worker
+page_retries = 3
+# how many times a failed split is put back in the worker queue before giving up
+task_max_attempts = 5
+# a split put aside after failing is retried this many seconds times its failed attempts later
+requeue_delay = 2
+# find-wide-partitions: how many hot ranges to keep on every level (--top)
+wide_partitions_top = 10
+# and by how many powers of 10 the split size shrinks from level to level
+wide_partitions_level_step = 3
+# approximate counting (--approximate)
+# sampling goes on until at least this many splits are counted
+approximate_min_splits = 30
+# z score of the confidence interval, 1.96 is 95% confidence
+approximate_z = 1.96
+# count-distinct, distinct values are counted exactly up to this many of them
+distinct_exact_limit = 100000
+# but workers switch to a sketch after this many in a split, to keep memory and messages small
+distinct_split_limit = 2000
+# and then estimated with a HyperLogLog sketch of 2^hll_precision registers, standard error 1.04 / sqrt(2^precision)
+hll_precision = 14
+# shared work ledger (--ledger)
+# a chunk leased by a participant holds this many splits
+ledger_chunk_splits = 100
+# or fewer, so that the ring is cut into at least this many chunks
+ledger_min_chunks = 100
+# but the ring is never cut into more chunks than this
+ledger_max_chunks = 100000
+# unfinished chunks a participant holds at once, more if workers can run more splits at once than that
+ledger_leased_chunks = 2
+# how often the splitter checks if the main process has finished enough chunks to lease the next one, seconds
+ledger_lease_check_interval = 0.1
+# leases not renewed for this long, in seconds, are taken over by other participants
+ledger_lease_time = 60
+# how often a participant with nothing to lease checks for expired leases, seconds
+ledger_poll_interval = 5
+# how long to wait for other participants' ledger transactions, seconds
+ledger_busy_timeout = 30
+# gzip compression level of export-rows shards (--gzip), 1 is fastest and 9 smallest
+export_gzip_level = 6
+# most split indices a worker claims at once from the split plan
+split_claim_size = 64
+# adaptive split sizing (--adaptive)
+# splits returning more rows or taking longer than this get subdivided
+adaptive_target_rows = 5000
+adaptive_max_latency = 2
+# split size limits, as powers of 10
+adaptive_min_split = 3
+adaptive_max_split = 18
+# how many splits each concurrent query of a worker thread may have in flight before
+# the splitter waits for feedback
+adaptive_in_flight = 10
+# how many times a failed split is retried
+adaptive_max_retries = 5
+# rate limiting (--max-rate), the query rate is kept between --min-rate and --max-rate
+rate_min = 10
+# queries slower than this are a sign of overload, seconds (--target-latency)
+rate_target_latency = 0.5
+# how often the rate is adjusted, seconds
+rate_adjust_interval = 1
+# while the cluster keeps up, the rate grows by this share of --max-rate every interval
+rate_increase = 0.05
+# and it is multiplied by this on timeouts or when too many queries are slow
+rate_decrease = 0.5
+# share of slow queries in an interval that is still fine
+rate_slow_share = 0.1
+# how many queries can be sent at once, in seconds worth of the current rate
+rate_burst = 0.1
+# metrics (--metrics-port, --metrics-file)
+# address the metrics endpoint listens on, use "0.0.0.0" to make it reachable from other hosts
+metrics_address = "127.0.0.1"
+# how often the JSON snapshot is written, seconds
+metrics_snapshot_interval = 10
+# upper bounds of query latency histogram buckets, seconds
+metrics_latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# how many of the slowest and largest token ranges are listed after a run with --trace
+trace_report_top = 10
 # you can also specify your database credentials here
 # when specified here, they will take precedence over same
 # settings specified on the CLI
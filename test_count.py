@@ -1,5 +1,30 @@
+import csv
+import gzip
+import json
+import multiprocessing
+import pickle
+import time
+from collections import namedtuple
+
+import pytest
+
 import count
-import presentation
+import settings
+from trireme import presentation
+from trireme.adaptive import AdaptiveSplitSizer
+from trireme.datastructures import Token_range, Queues, RuntimeSettings, CassandraSettings
+from trireme.fakecassandra import FakeTable, FakeSession, FakeSessionFactory, partition_token
+from trireme.export import Manifest, ShardWriter, add_range
+from trireme.hll import DistinctCounter
+from trireme.journal import Journal
+from trireme.ledger import Ledger
+from trireme.metrics import LatencyHistogram, Metrics
+from trireme.ratelimit import RateLimiter
+from trireme.routing import ReplicaRouter
+from trireme.splitplan import RandomOrder, SplitPlan
+from trireme.stats import StatsCounters
+from trireme.tokenring import owned_ranges, subtract_ranges, tokens_from_token_map
+from trireme.trace import start_trace, trace_report
 
 
 def test_seconds_to_human():
@@ -8,7 +33,511 @@ def test_seconds_to_human():
     assert presentation.seconds_to_human(52812) == (14, 40, 12)
 
 def test_human_time():
-    assert presentation.human_time(60) == "{} hours, {} minutes, {} seconds".format(0, 1, 0)
-    assert presentation.human_time(1562) == "{} hours, {} minutes, {} seconds".format(0, 26, 2)
-    assert presentation.human_time(2512) == "{} hours, {} minutes, {} seconds".format(0, 41, 52)
-    assert presentation.human_time(13749) == "{} hours, {} minutes, {} seconds".format(3, 49, 9)
\ No newline at end of file
+    assert presentation.human_time(42) == "{} seconds".format(42)
+    assert presentation.human_time(60) == "{} minutes, {} seconds".format(1, 0)
+    assert presentation.human_time(1562) == "{} minutes, {} seconds".format(26, 2)
+    assert presentation.human_time(2512) == "{} minutes, {} seconds".format(41, 52)
+    assert presentation.human_time(13749) == "{} hours, {} minutes, {} seconds".format(3, 49, 9)
+
+
+FakeToken = namedtuple("FakeToken", "value")
+FakeTokenMap = namedtuple("FakeTokenMap", "ring")
+
+
+def test_owned_ranges():
+    token_map = FakeTokenMap([FakeToken(100), FakeToken(-50), FakeToken(0)])
+    tokens = tokens_from_token_map(token_map)
+    assert tokens == [-50, 0, 100]
+    tr = Token_range(settings.default_min_token, settings.default_max_token)
+    assert owned_ranges(tokens, tr) == [(settings.default_min_token, -49), (-49, 1), (1, 101),
+                                        (101, settings.default_max_token)]
+    assert owned_ranges(tokens, Token_range(-10, 50)) == [(-10, 1), (1, 50)]
+    assert owned_ranges([], tr) == [(tr.min, tr.max)]
+
+
+def test_adaptive_split_sizer():
+    sizer = AdaptiveSplitSizer(1000, 10, 100000, target_rows=100, max_latency=2)
+    assert sizer.feedback(rows=400, latency=0.1) == 250
+    assert sizer.feedback(rows=10, latency=4) == 125
+    assert sizer.feedback(rows=0, latency=0.1) == 250
+    assert sizer.feedback(rows=60, latency=0.1) == 250
+    assert sizer.subdivide(0, 100) == [(0, 50), (50, 100)]
+    assert sizer.step == 50
+    # never smaller than min_step
+    assert sizer.subdivide(0, 15) == [(0, 10), (10, 15)]
+
+
+def count_events(stats):
+    for i in range(1000):
+        stats.add("results")
+    stats.flush()
+
+
+def test_stats_counters():
+    stats = StatsCounters(flush_interval=60)
+    stats.add("splits", 5)
+    assert stats.get("splits") == 0  # not flushed yet
+    stats.flush()
+    assert stats.get("splits") == 5
+    processes = [multiprocessing.Process(target=count_events, args=(stats,)) for i in range(3)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    assert stats.snapshot()["results"] == 3000
+    # counters are pickled for spawned processes, the default on Windows and macOS, without local counts
+    stats.add("results")
+    copy = StatsCounters.__new__(StatsCounters)
+    copy.__setstate__(stats.__getstate__())
+    count_events(copy)
+    assert stats.snapshot()["results"] == 4000
+
+
+def test_subtract_ranges():
+    assert subtract_ranges([(0, 100)], []) == [(0, 100)]
+    assert subtract_ranges([(0, 100)], [(10, 20), (20, 30), (90, 120)]) == [(0, 10), (30, 90)]
+    assert subtract_ranges([(0, 10), (20, 30)], [(0, 30)]) == []
+
+
+def test_journal(tmp_path):
+    path = str(tmp_path / "journal.db")
+    journal = Journal(path, {"action": "count-rows"})
+    assert journal.open()
+    journal.record(0, 10, 5)
+    journal.record(10, 20, 7)
+    journal.close()
+
+    journal = Journal(path, {"action": "count-rows"})
+    assert journal.open(resume=True)
+    assert journal.completed_ranges() == [(0, 10), (10, 20)]
+    assert journal.total() == 12
+    journal.close()
+
+    assert not Journal(path, {"action": "print-rows"}).open(resume=True)
+    # without resume the journal starts over
+    journal = Journal(path, {"action": "print-rows"})
+    assert journal.open()
+    assert journal.total() == 0
+
+
+def fake_rsettings(table, **session_options):
+    rsettings = RuntimeSettings()
+    rsettings.keyspace = "test"
+    rsettings.table = "fake"
+    rsettings.key = "id"
+    rsettings.extra_key = "ck"
+    rsettings.split = 18
+    rsettings.workers = 2
+    rsettings.tr = Token_range(settings.default_min_token, settings.default_max_token)
+    rsettings.split_ranges = [(rsettings.tr.min, rsettings.tr.max)]
+    rsettings.cas_settings = CassandraSettings()
+    rsettings.cas_settings.host = "fake"
+    rsettings.cas_settings.session_factory = FakeSessionFactory(table, **session_options)
+    return rsettings
+
+
+def run_pipeline(consumer, rsettings):
+    queues = Queues()
+    pm = multiprocessing.Process(target=count.process_manager, args=(queues, rsettings))
+    pm.start()
+    result = consumer(queues, rsettings)
+    pm.join()
+    return result
+
+
+def test_count_rows_with_fake_session():
+    table = FakeTable(partitions=500, rows_per_partition=2, row_size=10)
+    rsettings = fake_rsettings(table)
+    assert run_pipeline(count.get_rows_count, rsettings) == 1000
+    rsettings.concurrency = 4
+    rsettings.fetch_size = 7
+    rows = run_pipeline(lambda q, r: [row for batch in count.get_rows(q, r) for row in batch.value], rsettings)
+    assert len(rows) == 1000
+    rsettings.split = 17
+    rsettings.threads = 3
+    assert run_pipeline(count.get_rows_count, rsettings) == 1000
+    rsettings.concurrency = 1
+    assert run_pipeline(count.get_rows_count, rsettings) == 1000
+
+
+def test_async_worker_failures(monkeypatch):
+    # failed pages are retried and then put aside, without delays and without giving up
+    monkeypatch.setattr(settings, "page_retries", 1)
+    monkeypatch.setattr(settings, "requeue_delay", 0)
+    monkeypatch.setattr(settings, "task_max_attempts", 20)
+    table = FakeTable(partitions=100, rows_per_partition=2, row_size=1)
+    # the seed lets the first query of a worker, "use" of the keyspace, through
+    rsettings = fake_rsettings(table, failure_rate=0.5, seed=2)
+    rsettings.concurrency = 4
+    rsettings.fetch_size = 5
+    queues = Queues()
+    pm = multiprocessing.Process(target=count.process_manager, args=(queues, rsettings))
+    pm.start()
+    rows = [(row["id"], row["ck"]) for batch in count.get_rows(queues, rsettings) for row in batch.value]
+    pm.join()
+    # tasks continue from the page that failed, so no row is lost or read twice
+    assert sorted(rows) == sorted((r.id, r.ck) for r in table.rows)
+    assert queues.stats.get("retries") > 0
+    assert queues.stats.get("requeued") > 0
+    assert queues.stats.get("failed") == 0
+
+
+def test_find_wide_partitions():
+    table = FakeTable(partitions=300, row_size=1, wide_partitions={7: 50, 42: 20})
+    rsettings = fake_rsettings(table)
+    rsettings.split = 17
+    hottest = count.find_wide_partitions(rsettings, top=2)
+    assert hottest == [(50, (partition_token(7), partition_token(7) + 1)),
+                       (20, (partition_token(42), partition_token(42) + 1))]
+
+
+def test_replica_router():
+    session = FakeSession(FakeTable(partitions=1), vnodes=4, hosts=2)
+    router = ReplicaRouter(session, "test")
+    ring = [t.value for t in session.cluster.metadata.token_map.ring]
+    (first, second) = session.cluster.hosts
+    # a token is owned by the first ring token that is not smaller than it
+    assert router.host(ring[0]) is first
+    assert router.host(ring[0] + 1) is second
+    assert router.host(ring[-1] + 1) is first
+    second.is_up = False
+    assert router.host(ring[0] + 1) is None
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(max_rate=1000, min_rate=100, target_latency=0.1, adjust_interval=0)
+    assert limiter.rate == 100
+    limiter.feedback(0.01)
+    assert limiter.rate == 150
+    limiter.feedback(error=True)
+    assert limiter.rate == 100
+    limiter.feedback(1)
+    assert limiter.rate == 100
+    start = time.time()
+    for i in range(30):
+        limiter.acquire()
+    assert time.time() - start >= 0.2
+
+
+def test_failed_task_retries():
+    table = FakeTable(partitions=10, rows_per_partition=1, row_size=1)
+    rsettings = fake_rsettings(table)
+    queues = Queues()
+    pending = []
+    tasks = [count.CassandraWorkerTask("", (i, i + 1)) for i in range(3)]
+    count.retry_later(tasks[0], pending, 60)
+    count.retry_later(tasks[1], pending, 0)
+    count.retry_later(tasks[2], pending, 30)
+    assert pending == [tasks[1], tasks[2], tasks[0]]
+    # only tasks that are due are retried
+    assert count.next_task(queues, pending) is tasks[1]
+    assert count.next_task(queues, pending) is None
+    # tasks failing too many times are given up on and counted
+    task = count.CassandraWorkerTask("", (0, 1))
+    task.attempts = settings.task_max_attempts - 1
+    count.requeue_task(task, queues, rsettings, pending)
+    queues.stats.flush()
+    assert queues.stats.get("failed") == 1
+    assert len(pending) == 2
+    # in adaptive mode a split that fails before any page is read is handed back to the splitter,
+    # which is not a failure of the worker
+    rsettings.adaptive = True
+    session = FakeSession(table, failure_rate=1)
+    task = count.CassandraWorkerTask("select * from test.fake", (0, 1))
+    assert count.run_task(session, task, {}, queues, rsettings) is None
+    assert queues.feedback_queue.get(True, 1).failed
+
+
+def test_delete_page():
+    table = FakeTable(partitions=10, rows_per_partition=5, row_size=1)
+    rsettings = fake_rsettings(table)
+    queues = Queues()
+
+    # without a filter whole partitions are deleted, one statement per partition
+    session = FakeSession(table)
+    count.delete_page(session, table.rows, {}, queues, rsettings)
+    assert session.queries == 10
+    assert len(session.execute("select * from fake.table where token(id) >= {} and token(id) < {}".format(
+        settings.default_min_token, settings.default_max_token)).current_rows) == 0
+
+    # filtered rows are deleted in one batch per partition
+    rsettings.filter_string = "value = 'a' allow filtering"
+    session = FakeSession(table)
+    count.delete_page(session, table.rows[:12], {}, queues, rsettings)
+    assert session.queries == 3
+    assert session.deleted == set((r.id, r.ck) for r in table.rows[:12])
+    # whole partitions and single rows are counted apart, every key read counts as
+    # a partition, the select for whole partitions is distinct
+    queues.stats.flush()
+    assert queues.stats.get("deleted_partitions") == len(table.rows)
+    assert queues.stats.get("deleted") == 12
+
+
+def test_update_rows_write():
+    table = FakeTable(partitions=5, rows_per_partition=2, row_size=1)
+    rsettings = fake_rsettings(table)
+    session = FakeSession(table)
+    task = count.CassandraWorkerTask("", (0, 0))
+    task.write_sql = count.update_sql(rsettings, "value")
+    task.write_values = ["it's"]
+    count.write_rows(session, task, table.rows, {}, Queues(), rsettings)
+    assert session.updated == dict(((r.id, r.ck), ("value", "it's")) for r in table.rows)
+    # values are converted for the type of the column, not guessed from how they look
+    assert count.get_update_value(rsettings, "value", "00123") == "00123"
+    assert count.get_update_value(rsettings, "ck", "00123") == 123
+    assert count.cql_value("True", "boolean") is True
+    assert count.cql_value("0x00ff", "blob") == b"\x00\xff"
+    for (value, cql_type) in [("x", "int"), ("yes", "boolean"), ("1.5x", "decimal"), ("[1]", "list<int>"),
+                             ("1", "counter")]:
+        with pytest.raises(ValueError):
+            count.cql_value(value, cql_type)
+    # workers send how many rows they updated
+    rsettings.fetch_size = 3
+    assert run_pipeline(lambda q, r: count.update_rows(q, r, "value", "x"), rsettings) == 10
+
+
+def test_find_nulls_with_fake_session(capsys):
+    table = FakeTable(partitions=1000, row_size=1, null_every=10)
+    rsettings = fake_rsettings(table)
+    rsettings.split = 17
+    rsettings.value_column = "value"
+    assert run_pipeline(count.find_null_cells, rsettings) == 100
+    capsys.readouterr()
+    assert run_pipeline(lambda q, r: count.find_null_cells(q, r, print_keys=True), rsettings) == 100
+    assert capsys.readouterr().out.count("'id':") == 100
+
+
+def test_delete_rows_with_fake_session(tmp_path):
+    table = FakeTable(partitions=500, rows_per_partition=3, row_size=1)
+    rsettings = fake_rsettings(table)
+    rsettings.split = 17
+    # whole partitions are deleted, only their keys are read
+    assert run_pipeline(count.delete_rows, rsettings) == 500
+    rsettings.filter_string = "value = 'a' allow filtering"
+    assert run_pipeline(count.delete_rows, rsettings) == 1500
+    # splits of several pages are recorded in the journal once
+    rsettings.fetch_size = 7
+    journal = Journal(str(tmp_path / "journal.db"), {"action": "delete-rows"})
+    assert journal.open()
+    assert run_pipeline(lambda q, r: count.delete_rows(q, r, journal), rsettings) == 1500
+    assert len(journal.completed_ranges()) == 185
+    assert journal.total() == 1500
+    # the primary key was looked up once, and a mapper still waiting for work stops with the run
+    assert rsettings.primary_key == count.get_primary_key(rsettings)
+    queues = Queues()
+    queues.kill.set()
+    assert count.mapper(queues, rsettings) is False
+
+
+def test_metrics():
+    histogram = LatencyHistogram([0.1, 1])
+    for latency in [0.05, 0.5, 0.7, 5]:
+        histogram.observe(latency)
+    assert histogram.cumulative() == [(0.1, 1), (1, 3), ("+Inf", 4)]
+    table = FakeTable(partitions=1)
+    rsettings = fake_rsettings(table)
+    rsettings.split_ranges = [(0, 100)]
+    queues = Queues()
+    queues.stats.add("tokens", 25)
+    queues.stats.flush()
+    metrics = Metrics(queues, rsettings)
+    metrics.merge_latencies({"10.0.0.1": histogram})
+    assert metrics.snapshot()["progress"] == 0.25
+    text = metrics.openmetrics()
+    assert 'trireme_query_latency_seconds_bucket{host="10.0.0.1",le="+Inf"} 4' in text
+    assert "trireme_tokens_total 25" in text
+    assert text.endswith("# EOF\n")
+
+
+def test_trace(tmp_path):
+    table = FakeTable(partitions=500, rows_per_partition=2, row_size=10)
+    rsettings = fake_rsettings(table)
+    rsettings.split = 17
+    rsettings.trace_file = str(tmp_path / "trace.csv")
+    start_trace(rsettings.trace_file)
+    assert run_pipeline(count.get_rows_count, rsettings) == 1000
+    report = trace_report(rsettings.trace_file, top=3)
+    assert report["splits"] == 185
+    assert sum(rows for (host, (splits, execute, rows)) in report["hosts"].items()) == 1000
+    assert len(report["slowest"]) == 3
+    assert not report["failed"]
+
+
+def test_split_plan():
+    plan = SplitPlan([(0, 25), (30, 30), (40, 50)], 10, max_chunk=2)
+    assert plan.count == 4
+    assert [plan.split(i) for i in range(plan.count)] == [(0, 10), (10, 20), (20, 25), (40, 50)]
+    assert plan.claim() == (0, 1)
+    assert plan.claim() == (1, 2)
+    assert plan.claim() == (2, 3)
+    assert plan.claim() == (3, 4)
+    assert plan.claim() is None
+    # a full ring of single token splits
+    plan = SplitPlan([(settings.default_min_token, settings.default_max_token)], 1)
+    assert plan.split(plan.count - 1) == (settings.default_max_token - 1, settings.default_max_token)
+    assert plan.claim(4) == (0, settings.split_claim_size)
+
+
+def test_export_rows(tmp_path):
+    table = FakeTable(partitions=500, rows_per_partition=2, row_size=10)
+    rsettings = fake_rsettings(table)
+    rsettings.split = 17
+    rsettings.exporter = ShardWriter(str(tmp_path), "jsonl", compress=True)
+    manifest = Manifest(str(tmp_path), {"keyspace": "test", "table": "fake"})
+    assert run_pipeline(lambda q, r: count.export_rows(q, r, manifest), rsettings) == 1000
+    with open(manifest.path) as f:
+        shards = json.load(f)["shards"]
+    rows = []
+    for (name, shard) in shards.items():
+        with gzip.open(str(tmp_path / name), "rt") as f:
+            lines = [json.loads(line) for line in f]
+        assert len(lines) == shard["rows"] == sum(r[2] for r in shard["ranges"])
+        rows.extend(lines)
+    assert sorted((r["id"], r["ck"]) for r in rows) == sorted((r.id, r.ck) for r in table.rows)
+    ranges = []
+    add_range(ranges, 10, 20, 1)
+    add_range(ranges, 30, 40, 1)
+    add_range(ranges, 20, 30, 1)
+    assert ranges == [[10, 40, 3]]
+    # a writer pickled for a spawned process does not take the open shard along
+    writer = ShardWriter(str(tmp_path), "csv", participant="host:1")
+    # shards of participants on other machines don't collide
+    assert writer.write(table.rows[:1]).startswith("part-{}-host-1-".format(writer.run))
+    copy = pickle.loads(pickle.dumps(writer))
+    assert copy.name is None
+    copy.close()
+    writer.close()
+
+
+def test_export_rows_csv(tmp_path):
+    # with few partitions most splits are empty, and workers get empty pages before their first row
+    table = FakeTable(partitions=20, rows_per_partition=2, row_size=10)
+    rsettings = fake_rsettings(table)
+    rsettings.split = 17
+    rsettings.exporter = ShardWriter(str(tmp_path), "csv")
+    manifest = Manifest(str(tmp_path), {"keyspace": "test", "table": "fake"})
+    queues = Queues()
+    pm = multiprocessing.Process(target=count.process_manager, args=(queues, rsettings))
+    pm.start()
+    assert count.export_rows(queues, rsettings, manifest) == 40
+    pm.join()
+    assert queues.stats.get("errors") == 0
+    rows = []
+    for name in manifest.shards:
+        with open(str(tmp_path / name), newline="") as f:
+            lines = list(csv.DictReader(f))
+        assert len(lines) == manifest.shards[name]["rows"]
+        rows.extend(lines)
+    assert sorted((int(r["id"]), int(r["ck"])) for r in rows) == sorted((r.id, r.ck) for r in table.rows)
+
+
+def count_with_ledger(rsettings, path, participant, totals, delay=0):
+    time.sleep(delay)
+    ledger = Ledger(path, {"action": "count-rows"}, participant)
+    assert ledger.open(rsettings.split_ranges, pow(10, rsettings.split))
+    rsettings.ledger_path = path
+    rsettings.participant = participant
+    totals.put(run_pipeline(lambda q, r: count.get_rows_count(q, r, ledger), rsettings))
+    ledger.close()
+
+
+def test_ledger(tmp_path):
+    path = str(tmp_path / "ledger.db")
+    table = FakeTable(partitions=500, rows_per_partition=2, row_size=1)
+    rsettings = fake_rsettings(table)
+    rsettings.split = 16
+    totals = multiprocessing.Queue()
+    participants = [multiprocessing.Process(target=count_with_ledger, args=(rsettings, path, name, totals))
+                    for name in ["a", "b"]]
+    for p in participants:
+        p.start()
+    for p in participants:
+        p.join()
+    assert [totals.get(), totals.get()] == [1000, 1000]
+
+    # a participant joining late still gets work, the first one does not lease far ahead
+    path = str(tmp_path / "late.db")
+    table = FakeTable(partitions=500, rows_per_partition=2, row_size=1)
+    rsettings = fake_rsettings(table, latency=0.02)
+    rsettings.split = 17
+    participants = [multiprocessing.Process(target=count_with_ledger, args=(rsettings, path, name, totals, delay))
+                    for (name, delay) in [("a", 0), ("b", 1)]]
+    for p in participants:
+        p.start()
+    for p in participants:
+        p.join()
+    assert [totals.get(), totals.get()] == [1000, 1000]
+    ledger = Ledger(path, {"action": "count-rows"})
+    ledger.connect()
+    owners = dict(ledger._connection.execute("select owner, count(*) from chunks group by owner").fetchall())
+    assert owners["a"] > 0 and owners["b"] > 0
+    assert sum(owners.values()) == 185
+
+    # leases that are not renewed are taken over
+    ranges = [(0, 1000)]
+    first = Ledger(str(tmp_path / "leases.db"), {}, "first", lease_time=0)
+    assert first.open(ranges, 100)
+    assert first.lease() == (0, 100)
+    second = Ledger(str(tmp_path / "leases.db"), {}, "second")
+    assert second.open(ranges, 100)
+    assert not second.others_working()
+    assert second.lease() == (0, 100)
+    second.record(0, 100, 1)
+    first.record(0, 100, 1)
+    assert second.total() == 1
+    assert second.unfinished() == 9
+    # chunks with a failed split are not worked on anymore, and are released on close
+    assert second.lease() == (100, 200)
+    assert second.leased() == 1
+    second.fail(150, 160)
+    assert second.leased() == 0
+    assert not second.others_working()
+    second.close()
+    third = Ledger(str(tmp_path / "leases.db"), {}, "third")
+    assert third.open(ranges, 100)
+    assert third.lease() == (100, 200)
+    assert not Ledger(str(tmp_path / "leases.db"), {"action": "other"}).open(ranges, 10)
+
+
+def test_approximate_count():
+    table = FakeTable(partitions=5000, rows_per_partition=2, row_size=1)
+    rsettings = fake_rsettings(table)
+    rsettings.split = 16
+    rsettings.split_plan = SplitPlan(rsettings.split_ranges, pow(10, rsettings.split), shuffle=True)
+    rsettings.split_plan.order = RandomOrder(rsettings.split_plan.count, seed=1)
+    estimator = run_pipeline(lambda q, r: count.approximate_count(q, r, error=0.1), rsettings)
+    assert settings.approximate_min_splits <= estimator.samples < estimator.splits
+    assert abs(estimator.estimate() - 10000) <= estimator.margin() <= 1000
+    # when every split gets counted the count is exact
+    rsettings.split = 17
+    rsettings.split_plan = SplitPlan(rsettings.split_ranges, pow(10, rsettings.split), shuffle=True)
+    estimator = run_pipeline(lambda q, r: count.approximate_count(q, r, error=0), rsettings)
+    assert (estimator.estimate(), estimator.margin()) == (10000, 0)
+    # while no result comes the consumer calls back, that's where the time budget is checked too
+    queues = Queues()
+    rsettings.workers = 1
+
+    def idle():
+        queues.results_queue.put(False)
+
+    assert list(count.consume_results(queues, rsettings, idle=idle)) == []
+    assert queues.kill.is_set()
+
+
+def test_count_distinct():
+    table = FakeTable(partitions=1000, rows_per_partition=3, row_size=1)
+    rsettings = fake_rsettings(table)
+    rsettings.split = 17
+    rsettings.value_column = "value"
+    total = run_pipeline(count.count_distinct, rsettings)
+    assert total.exact and total.count() == len(set(r.value for r in table.rows))
+    rsettings.value_column = "id, ck"
+    assert run_pipeline(count.count_distinct, rsettings).count() == 3000
+
+    counters = [DistinctCounter(limit=1000) for i in range(4)]
+    for i in range(200000):
+        counters[i % 4].add(i % 100000)
+    for counter in counters[1:]:
+        counters[0].merge(counter)
+    assert not counters[0].exact
+    assert abs(counters[0].count() - 100000) < 100000 * 3 * counters[0].hll.error()
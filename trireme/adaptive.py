@@ -0,0 +1,58 @@
+import math
+
+
+class AdaptiveSplitSizer:
+    """Tune split size based on the feedback from finished splits.
+
+    Splits that return more rows than 'target_rows' or take longer than
+    'max_latency' seconds make the following splits smaller,
+    empty and cheap splits make them bigger, so that long empty stretches
+    of the token range are covered with few queries.
+    Step is always kept between 'min_step' and 'max_step'.
+    """
+
+    def __init__(self, step, min_step, max_step, target_rows, max_latency):
+        self.step = step
+        self.min_step = min_step
+        self.max_step = max_step
+        self.target_rows = target_rows
+        self.max_latency = max_latency
+
+    def __str__(self):
+        return "AdaptiveSplitSizer(step: {}, min: {}, max: {})".format(
+            self.step, self.min_step, self.max_step)
+
+    def _load(self, rows, latency):
+        """How many times the split was over the target."""
+        return max(rows / self.target_rows, latency / self.max_latency)
+
+    def _clip(self, step):
+        return int(min(self.max_step, max(self.min_step, step)))
+
+    def feedback(self, rows, latency):
+        """Adjust split size after a split has finished."""
+        load = self._load(rows, latency)
+        if load > 1:
+            self.step = self._clip(self.step // math.ceil(load))
+        elif load < 0.5:
+            # grow at most twice at a time, as one empty split
+            # does not say much about the rest of the range
+            self.step = self._clip(self.step * 2)
+        return self.step
+
+    def subdivide(self, split_min, split_max, rows=0, latency=0):
+        """Cut a split that failed or was too heavy into smaller pieces.
+
+        The split is cut into at least two pieces, but none of them is
+        smaller than 'min_step'.
+        """
+        pieces = max(2, math.ceil(self._load(rows, latency)))
+        piece_size = max(self.min_step, -(-(split_max - split_min) // pieces))
+        self.step = self._clip(min(self.step, piece_size))
+        subsplits = []
+        i = split_min
+        while i < split_max:
+            i_max = min(i + piece_size, split_max)
+            subsplits.append((i, i_max))
+            i = i_max
+        return subsplits
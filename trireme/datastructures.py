@@ -1,31 +1,29 @@
+import heapq
 import multiprocessing
 import queue
+import threading
+import time
 
-from settings import split_q_size, worker_q_size, mapper_q_size, reducer_q_size, results_q_size, stats_q_size
+from settings import split_q_size, worker_q_size, mapper_q_size, results_q_size, \
+    feedback_q_size, latency_q_size, trace_q_size, stats_flush_interval
+from trireme.stats import StatsCounters
 
 
 class Result:
-    def __init__(self, min, max, value):
+    def __init__(self, min, max, value, complete=True, failed=False):
         self.min = min
         self.max = max
         self.value = value
+        # False for all but the last batch of a split
+        self.complete = complete
+        # True for a split that was given up on, sent only with a ledger
+        self.failed = failed
 
     def __str__(self):
         return "Result(min: {}, max: {}, value: {})".format(
             self.min, self.max, self.value)
 
 
-class RowForDeletion:
-    def __init__(self, min, max, row):
-        self.min = min
-        self.max = max
-        self.row = row
-
-    def __str__(self):
-        return "Row for deletion: (min: {}, max: {}, row: {})".format(
-            self.min, self.max, self.row)
-
-
 class Settings:
     def __init__(self):
         pass
@@ -37,38 +35,149 @@ class Token_range:
         self.max = max
 
 
+class SplitFeedback:
+    """Outcome of a finished split, sent from workers back to the splitter."""
+    def __init__(self, min, max, rows, latency, failed=False):
+        self.min = min
+        self.max = max
+        self.rows = rows
+        self.latency = latency
+        self.failed = failed
+
+    def __str__(self):
+        return "SplitFeedback(min: {}, max: {}, rows: {}, latency: {}, failed: {})".format(
+            self.min, self.max, self.rows, self.latency, self.failed)
+
+
+class TopK:
+    """Keeps the k items with the biggest counts, in a bounded min-heap."""
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+
+    def add(self, count, item):
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, (count, item))
+        elif count > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (count, item))
+
+    def items(self):
+        """Return (count, item) tuples, biggest count first."""
+        return sorted(self.heap, reverse=True)
+
+
 class Mapper_task:
     def __init__(self, sql_statement, key_column, filter_string):
         self.sql_statement = sql_statement
         self.key_column = key_column
         self.filter_string = filter_string
         self.parser = None
+        self.task_type = "select"
+        # statement executed by workers for every row they read, with values
+        # bound before the primary key of the row
+        self.write_sql = None
+        self.write_values = []
 
     def __str__(self):
         return "Mapper task: {}".format(self.sql_statement)
 
 
+class SplitPlanJob:
+    """Statement of the job, workers build tasks for the splits they claim from the split plan with it."""
+    def __init__(self, sql, parser=None, task_type="select", write_sql=None, write_values=None):
+        self.sql = sql
+        self.parser = parser
+        self.task_type = task_type
+        self.write_sql = write_sql
+        self.write_values = write_values or []
+
+    def task(self, split):
+        t = CassandraWorkerTask(self.sql, split, self.parser, parameters=split)
+        t.task_type = self.task_type
+        t.write_sql = self.write_sql
+        t.write_values = self.write_values
+        return t
+
+    def __str__(self):
+        return "SplitPlanJob: {}".format(self.sql)
+
+
 class Queues:
 
     def __init__(self):
         self.split_queue = multiprocessing.Queue(split_q_size)
         self.worker_queue = multiprocessing.Queue(worker_q_size)
         self.mapper_queue = multiprocessing.Queue(mapper_q_size)
-        self.reducer_queue = multiprocessing.Queue(reducer_q_size)
         self.results_queue = multiprocessing.Queue(results_q_size)
+        # workers report finished splits back to the splitter when adaptive split sizing is used
+        self.feedback_queue = multiprocessing.Queue(feedback_q_size)
+        # tasks left unfinished by workers that died, picked up before any new work
+        self.retry_queue = multiprocessing.Queue()
+        # timings of finished splits, written to the trace file by the trace writer
+        self.trace_queue = multiprocessing.Queue(trace_q_size)
 
-        # stats queues are used to count events and calculate performance metrics
-        self.stats_queue_splits = multiprocessing.Queue(stats_q_size)
-        self.stats_queue_mapper = multiprocessing.Queue(stats_q_size)
-        self.stats_queue_worker = multiprocessing.Queue(stats_q_size)
-        self.stats_queue_results = multiprocessing.Queue(stats_q_size)
-        self.stats_queue_deleted = multiprocessing.Queue(stats_q_size)
-        self.stats_queue_delete_scheduled = multiprocessing.Queue(stats_q_size)
-        self.stats_queue_results_consumed = multiprocessing.Queue(stats_q_size)
+        # latency histograms sent by workers to the metrics server
+        self.latency_queue = multiprocessing.Queue(latency_q_size)
+        # stats counters are used to count events and calculate performance metrics
+        self.stats = StatsCounters(stats_flush_interval, self.latency_queue)
         # kill event, while it is not a queue, we'd love to pass it around
         self.kill = multiprocessing.Event()
 
 
+class WorkerControl:
+    """Coordinates threads of a worker process.
+
+    The first kill pill taken by any of the threads stops all of them.
+    Kill pills taken after that belong to other worker processes
+    and are put back in the worker queue.
+
+    With a split plan, threads share the chunk of split indices claimed
+    by the process, and running out of splits counts as a kill pill.
+    """
+
+    def __init__(self):
+        self.stopping = threading.Event()
+        self.pill = False
+        self.failed = False
+        # SplitPlanJob of the process, None when tasks come from the worker queue
+        self.job = None
+        self._claimed = None
+        self._lock = threading.Lock()
+
+    def kill_pill(self, queues):
+        with self._lock:
+            if self.pill:
+                if self.job is None:
+                    queues.worker_queue.put(False)
+            else:
+                self.pill = True
+                self.stopping.set()
+
+    def next_split(self, plan, claimers):
+        """Return index of the next split to run, None when the plan has no splits left."""
+        with self._lock:
+            if self._claimed is None or self._claimed[0] >= self._claimed[1]:
+                self._claimed = plan.claim(claimers)
+                if self._claimed is None:
+                    return None
+            index = self._claimed[0]
+            self._claimed = (index + 1, self._claimed[1])
+            return index
+
+    def unclaimed(self):
+        """Return indices of claimed splits that have not been started and forget them."""
+        with self._lock:
+            if self._claimed is None:
+                return []
+            indices = range(*self._claimed)
+            self._claimed = None
+            return indices
+
+    def fail(self):
+        self.failed = True
+        self.stopping.set()
+
+
 class RuntimeSettings:
     """Object for passing around settings for runtime use"""
     def __init__(self):
@@ -80,7 +189,32 @@ class RuntimeSettings:
         self.value_column = None
         self.filter_string = None
         self.tr = None
+        self.split_mode = "fixed"
+        self.ring_file = None
+        self.split_ranges = None
+        self.adaptive = False
+        # partition key and clustering columns of the table, see get_primary_key in count.py
+        self.primary_key = None
+        # path of the shared work ledger and our name in it, see trireme.ledger
+        self.ledger_path = None
+        self.participant = None
+        # SplitPlan shared by workers, set by process manager unless splits are adaptive
+        self.split_plan = None
         self.cas_settings = None
+        self.workers = 1
+        self.threads = 1
+        self.concurrency = 1
+        self.fetch_size = 5000
+        self.token_aware = True
+        # RateLimiter shared by all workers, None when the query rate is not limited
+        self.rate_limiter = None
+        # metrics endpoint port and JSON snapshot file, see trireme.metrics
+        self.metrics_port = None
+        self.metrics_file = None
+        # ShardWriter of export-rows, see trireme.export
+        self.exporter = None
+        # CSV file with timings of every split, see trireme.trace
+        self.trace_file = None
         self.worker_max_delay_on_startup = 0
 
 
@@ -94,15 +228,41 @@ class CassandraSettings:
         self.ssl_cert = None
         self.ssl_key = None
         self.ssl_v1 = None
+        self.cacert = None
+        self.dc = None
+        # callable returning a session for a host, used instead of a real
+        # cluster by tests and benchmarks
+        self.session_factory = None
 
 
 class CassandraWorkerTask:
-    def __init__(self, sql, split, parser=None):
+    def __init__(self, sql, split, parser=None, parameters=None):
         self.sql = sql
+        self.parameters = parameters
         self.parser = parser
         self.split_min = split[0]
         self.split_max = split[1]
         self.task_type = "select"
+        self.write_sql = None
+        self.write_values = []
+        # DistinctCounter of count-distinct tasks, filled page by page
+        self.distinct = None
+        # paging state of the next page, so that a failed task can continue
+        # from where it stopped
+        self.paging_state = None
+        self.created = time.time()
+        self.started = None
+        self.page_started = None
+        # timings for the trace, see trireme.trace
+        self.execute_time = 0
+        self.pages = 0
+        self.bytes = 0
+        self.host = None
+        self.rows = 0
+        self.retries = 0
+        self.attempts = 0
+        # time a task put aside after failing is due to be retried
+        self.due = None
 
     def __str__(self):
         return "CassandraWorkerTask: {}".format(self.sql)
\ No newline at end of file
@@ -0,0 +1,148 @@
+import bisect
+import collections.abc
+import csv
+import gzip
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import settings
+
+
+def json_value(value):
+    """Convert Cassandra values json does not know about."""
+    if isinstance(value, (bytes, bytearray)):
+        return "0x" + value.hex()
+    if isinstance(value, collections.abc.Mapping):
+        return {str(k): v for (k, v) in value.items()}
+    if isinstance(value, collections.abc.Iterable) and not isinstance(value, str):
+        return list(value)
+    return str(value)
+
+
+def csv_value(value):
+    if isinstance(value, (bytes, bytearray)):
+        return "0x" + value.hex()
+    return value
+
+
+class ShardWriter:
+    """Writes rows read by a worker process to its own shard file.
+
+    The writer is created by the main process and copied to every worker
+    when it is forked. Each worker opens its shard on the first write, named
+    after the run, the participant (host name by default) and its pid, so
+    workers never share a file, even with other machines writing to the same
+    directory. Threads of a worker share the shard.
+    """
+
+    def __init__(self, directory, format="jsonl", compress=False, participant=None):
+        self.directory = directory
+        self.format = format
+        self.compress = compress
+        # shards of different runs to the same directory don't collide
+        self.run = time.strftime("%Y%m%d%H%M%S")
+        self.participant = (participant or socket.gethostname()).replace(":", "-").replace(os.sep, "-")
+        self.name = None
+        self._file = None
+        self._csv = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # spawned processes open a shard of their own, the same as forked ones
+        state = dict(self.__dict__)
+        state.update(name=None, _file=None, _csv=None)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _open(self, columns):
+        self.name = "part-{}-{}-{}.{}".format(self.run, self.participant, os.getpid(), self.format)
+        path = os.path.join(self.directory, self.name)
+        if self.compress:
+            self.name += ".gz"
+            self._file = gzip.open(path + ".gz", "wt", compresslevel=settings.export_gzip_level, newline="")
+        else:
+            self._file = open(path, "w", newline="")
+        if self.format == "csv":
+            self._csv = csv.writer(self._file)
+            self._csv.writerow(columns)
+        logging.debug("Writing rows to shard {}".format(self.name))
+
+    def write(self, rows, flush=False):
+        """Write rows (named tuples) to the shard and return its name, None if nothing was written yet."""
+        with self._lock:
+            if self._file is None:
+                if not rows:
+                    # empty pages before the first row don't open a shard
+                    return self.name
+                self._open(rows[0]._fields)
+            if self.format == "csv":
+                self._csv.writerows([csv_value(v) for v in row] for row in rows)
+            else:
+                for row in rows:
+                    self._file.write(json.dumps(row._asdict(), default=json_value))
+                    self._file.write("\n")
+            if flush:
+                # rows of finished splits are on disk before the split is reported as done
+                self._file.flush()
+            return self.name
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def add_range(ranges, split_min, split_max, rows):
+    """Add token range to sorted [min, max, rows] list, merging it with the ranges next to it."""
+    i = bisect.bisect_left(ranges, [split_min])
+    if i > 0 and ranges[i - 1][1] == split_min:
+        i -= 1
+        ranges[i][1] = split_max
+        ranges[i][2] += rows
+    else:
+        ranges.insert(i, [split_min, split_max, rows])
+    if i + 1 < len(ranges) and ranges[i + 1][0] == ranges[i][1]:
+        ranges[i][1] = ranges[i + 1][1]
+        ranges[i][2] += ranges[i + 1][2]
+        del ranges[i + 1]
+
+
+class Manifest:
+    """List of shards of an export, with the token ranges and row counts each of them holds."""
+
+    def __init__(self, directory, job, name="manifest.json"):
+        self.path = os.path.join(directory, name)
+        self.job = job
+        self.shards = {}
+
+    def load(self):
+        """Continue the manifest of an earlier run of the same export."""
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.shards = json.load(f)["shards"]
+
+    def add(self, shard, split_min, split_max, rows):
+        entry = self.shards.setdefault(shard, {"rows": 0, "ranges": []})
+        entry["rows"] += rows
+        add_range(entry["ranges"], split_min, split_max, rows)
+
+    def rows(self):
+        return sum(entry["rows"] for entry in self.shards.values())
+
+    def write(self):
+        manifest = dict(self.job)
+        manifest["rows"] = self.rows()
+        manifest["shards"] = self.shards
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,379 @@
+"""In-memory stand-in for a Cassandra session, used by tests and benchmarks.
+
+The table is partitioned by the Murmur3 token of its partition key, so token
+range queries built by trireme return the same rows they would on a real
+cluster. Latency, row sizes and failures are configurable.
+Only the statements that trireme itself generates are understood.
+"""
+import bisect
+import functools
+import heapq
+import itertools
+import random
+import re
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from cassandra import OperationTimedOut
+from cassandra.metadata import Murmur3Token
+from cassandra.query import BatchStatement, BoundStatement, SimpleStatement
+
+import settings
+
+FakeRow = namedtuple("FakeRow", "id ck value")
+CountRow = namedtuple("CountRow", "count")
+
+select_re = re.compile(r"select (?P<columns>.+?) from (?P<table>\S+) where token\((?P<token_columns>[^)]*)\) >= (?P<min>\S+) "
+                       r"and token\([^)]*\) < (?P<max>\S+)(?P<filter> and .*)?$", re.IGNORECASE)
+delete_re = re.compile(r"delete from (?P<table>\S+) where (?P<where>.*)$", re.IGNORECASE)
+update_re = re.compile(r"update (?P<table>\S+) set (?P<column>\S+) = (?P<value>.+) where (?P<where>.*)$", re.IGNORECASE)
+
+
+def partition_token(key):
+    return Murmur3Token.hash_fn(struct.pack(">q", key))
+
+
+class FakeTable:
+    """Table with columns 'id' (partition key), 'ck' (clustering key) and 'value'.
+
+    'wide_partitions' maps partition keys to their row count, for partitions
+    that should have more than 'rows_per_partition' rows. Value of every
+    'null_every'th row is null.
+    """
+
+    def __init__(self, partitions=10000, rows_per_partition=1, row_size=100, seed=0, wide_partitions=None,
+                 null_every=0):
+        rnd = random.Random(seed)
+        wide_partitions = wide_partitions or {}
+        rows = []
+        for key in range(partitions):
+            token = partition_token(key)
+            for ck in range(wide_partitions.get(key, rows_per_partition)):
+                value = "".join(rnd.choice("abcdefghij") for i in range(row_size))
+                if null_every and len(rows) % null_every == 0:
+                    value = None
+                rows.append((token, FakeRow(key, ck, value)))
+        rows.sort(key=lambda r: (r[0], r[1].ck))
+        self.tokens = [r[0] for r in rows]
+        self.rows = [r[1] for r in rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def token_range(self, min, max):
+        """Return rows with min <= token < max."""
+        return self.rows[bisect.bisect_left(self.tokens, min):bisect.bisect_left(self.tokens, max)]
+
+
+class FakeResultSet:
+    def __init__(self, rows, paging_state=None):
+        self.current_rows = rows
+        self.paging_state = paging_state
+
+    def __iter__(self):
+        return iter(self.current_rows)
+
+
+class FakePreparedStatement:
+    def __init__(self, sql):
+        self.sql = sql
+        self.query_id = sql
+
+    def bind(self, values):
+        return FakeBoundStatement(self, values)
+
+
+class FakeBoundStatement(BoundStatement):
+    """Bound statement that keeps its values as they are, so it can be added to a BatchStatement."""
+
+    def __init__(self, prepared, values):
+        self.prepared_statement = prepared
+        self.values = list(values)
+        self.fetch_size = None
+
+
+class FakeResponseFuture:
+    """Future that is completed by the session's event loop thread."""
+
+    def __init__(self, coordinator_host=None):
+        self.coordinator_host = coordinator_host
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        self._callbacks = None
+
+    def _complete(self, result, error):
+        with self._lock:
+            self._result = result
+            self._error = error
+            self._done.set()
+            callbacks = self._callbacks
+        if callbacks:
+            self._run_callbacks(*callbacks)
+
+    def _run_callbacks(self, callback, errback):
+        if self._error is not None:
+            errback(self._error)
+        else:
+            callback(self._result.current_rows)
+
+    def add_callbacks(self, callback, errback):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks = (callback, errback)
+                return
+        self._run_callbacks(callback, errback)
+
+    def result(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class FakeEventLoop(threading.Thread):
+    """Runs functions after a delay, like the driver's event loop completes requests."""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self._condition = threading.Condition()
+        self._queue = []
+        self._counter = itertools.count()
+
+    def call_later(self, delay, fn):
+        with self._condition:
+            heapq.heappush(self._queue, (time.time() + delay, next(self._counter), fn))
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._queue or self._queue[0][0] > time.time():
+                    timeout = self._queue[0][0] - time.time() if self._queue else None
+                    self._condition.wait(timeout)
+                (due, n, fn) = heapq.heappop(self._queue)
+            fn()
+
+
+@functools.total_ordering
+class FakeToken:
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return self.value < other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+
+class FakeHost:
+    def __init__(self, address, datacenter="dc1"):
+        self.address = address
+        self.datacenter = datacenter
+        self.is_up = True
+
+    def __repr__(self):
+        return "FakeHost({})".format(self.address)
+
+
+class FakeTokenMap:
+    """Token map where tokens are given to hosts in turns and each token is stored on one host."""
+    token_class = FakeToken
+
+    def __init__(self, tokens, hosts):
+        self.ring = [FakeToken(t) for t in sorted(tokens)]
+        self.owners = dict((token, hosts[i % len(hosts)]) for (i, token) in enumerate(self.ring))
+
+    def get_replicas(self, keyspace, token):
+        point = bisect.bisect_left(self.ring, token)
+        return [self.owners[self.ring[point % len(self.ring)]]]
+
+
+class FakeColumn:
+    def __init__(self, name, cql_type):
+        self.name = name
+        self.cql_type = cql_type
+
+
+class FakeTableMetadata:
+    columns = {"id": FakeColumn("id", "int"), "ck": FakeColumn("ck", "int"), "value": FakeColumn("value", "text")}
+    partition_key = [columns["id"]]
+    clustering_key = [columns["ck"]]
+
+
+class FakeSchema(dict):
+    """Schema where every name exists."""
+
+    def __init__(self, item_class):
+        super().__init__()
+        self.item_class = item_class
+
+    def get(self, name, default=None):
+        if name not in self:
+            self[name] = self.item_class()
+        return self[name]
+
+
+class FakeKeyspaceMetadata:
+    def __init__(self):
+        self.tables = FakeSchema(FakeTableMetadata)
+
+
+class FakeMetadata:
+    def __init__(self, tokens, hosts):
+        self.token_map = FakeTokenMap(tokens, hosts)
+        self.keyspaces = FakeSchema(FakeKeyspaceMetadata)
+
+
+class FakeCluster:
+    def __init__(self, tokens, hosts):
+        self.hosts = hosts
+        self.metadata = FakeMetadata(tokens, hosts)
+        self.is_shutdown = False
+
+    def shutdown(self):
+        self.is_shutdown = True
+
+
+class FakeSession:
+    """Session that runs trireme queries against a FakeTable."""
+
+    def __init__(self, table, latency=0, row_latency=0, failure_rate=0, vnodes=16, hosts=3, seed=None):
+        self.table = table
+        self.latency = latency
+        self.row_latency = row_latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        ring = random.Random(0)
+        self.cluster = FakeCluster([ring.randint(settings.default_min_token, settings.default_max_token)
+                                    for i in range(vnodes)],
+                                   [FakeHost("127.0.0.{}".format(i + 1)) for i in range(hosts)])
+        # deleted keys are only visible within this session
+        self.deleted = set()
+        # primary keys of updated rows, with the column and the value that was set
+        self.updated = {}
+        self.queries = 0
+        self._loop = None
+
+    @property
+    def is_shutdown(self):
+        return self.cluster.is_shutdown
+
+    def get_pool_state(self):
+        return dict((host, {}) for host in self.cluster.hosts)
+
+    def prepare(self, sql):
+        return FakePreparedStatement(sql)
+
+    def _statement(self, statement, parameters):
+        """Return CQL, bound values and fetch size of the statement."""
+        if isinstance(statement, str):
+            return statement, list(parameters or []), None
+        if isinstance(statement, SimpleStatement):
+            return statement.query_string, list(parameters or []), statement.fetch_size
+        if isinstance(statement, FakePreparedStatement):
+            return statement.sql, list(parameters or []), None
+        return statement.prepared_statement.sql, statement.values, statement.fetch_size
+
+    def _run(self, statement, parameters, paging_state):
+        self.queries += 1
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise OperationTimedOut("Fake timeout")
+        if isinstance(statement, BatchStatement):
+            for (prepared, sql, values) in statement._statements_and_parameters:
+                self._execute(sql, list(values), None, None)
+            return FakeResultSet([]), 0
+        sql, values, fetch_size = self._statement(statement, parameters)
+        return self._execute(sql, values, fetch_size, paging_state)
+
+    def _execute(self, sql, values, fetch_size, paging_state):
+        sql = sql.strip()
+        if sql.lower().startswith("use "):
+            return FakeResultSet([]), 0
+
+        match = delete_re.match(sql)
+        if match:
+            self.deleted.add(tuple(values))
+            return FakeResultSet([]), 0
+
+        match = update_re.match(sql)
+        if match:
+            value = values.pop(0) if match.group("value") == "?" else match.group("value")
+            self.updated[tuple(values)] = (match.group("column"), value)
+            return FakeResultSet([]), 0
+
+        match = select_re.match(sql)
+        if not match:
+            raise ValueError("Fake session does not understand: {}".format(sql))
+        bounds = [match.group("min"), match.group("max")]
+        bounds = [values.pop(0) if b == "?" else int(b) for b in bounds]
+        # rows with their position in the token range, the paging state is the position of
+        # the next row, so that rows deleted while paging don't shift the pages, like in Cassandra
+        rows = list(enumerate(self.table.token_range(bounds[0], bounds[1])))
+        if self.deleted:
+            rows = [(i, r) for (i, r) in rows if (r.id, r.ck) not in self.deleted and (r.id,) not in self.deleted]
+        columns = match.group("columns").strip()
+        if columns.lower() == "count(*)":
+            return FakeResultSet([CountRow(len(rows))]), 0
+        distinct = columns.lower().startswith("distinct ")
+        if distinct:
+            columns = columns[len("distinct "):]
+        if columns != "*":
+            names = [c.strip() for c in columns.split(",")]
+            row_class = namedtuple("Row", names)
+            rows = [(i, row_class(*[getattr(r, n) for n in names])) for (i, r) in rows]
+        if distinct:
+            # rows are ordered by token, so rows of a partition are next to each other
+            rows = [(i, r) for (j, (i, r)) in enumerate(rows) if j == 0 or r != rows[j - 1][1]]
+        rows = [(i, r) for (i, r) in rows if i >= (paging_state or 0)]
+        next_page = None
+        if fetch_size and len(rows) > fetch_size:
+            next_page = rows[fetch_size][0]
+            rows = rows[:fetch_size]
+        page = [r for (i, r) in rows]
+        return FakeResultSet(page, next_page), len(page)
+
+    def _coordinator(self, host):
+        if host is None:
+            host = self.random.choice(self.cluster.hosts)
+        return host.address
+
+    def execute(self, statement, parameters=None, paging_state=None, host=None, **kwargs):
+        result, rows = self._run(statement, parameters, paging_state)
+        delay = self.latency + rows * self.row_latency
+        if delay:
+            time.sleep(delay)
+        result.response_future = FakeResponseFuture(self._coordinator(host))
+        return result
+
+    def execute_async(self, statement, parameters=None, paging_state=None, host=None, **kwargs):
+        if self._loop is None:
+            self._loop = FakeEventLoop()
+            self._loop.start()
+        future = FakeResponseFuture(self._coordinator(host))
+        try:
+            result, rows = self._run(statement, parameters, paging_state)
+            error = None
+        except Exception as e:
+            result, rows, error = None, 0, e
+        delay = self.latency + rows * self.row_latency
+        self._loop.call_later(delay, lambda: future._complete(result, error))
+        return future
+
+
+class FakeSessionFactory:
+    """Creates fake sessions, set it as CassandraSettings.session_factory to use it."""
+
+    def __init__(self, table, **session_options):
+        self.table = table
+        self.session_options = session_options
+
+    def __call__(self, host):
+        return FakeSession(self.table, **self.session_options)
@@ -0,0 +1,95 @@
+import hashlib
+import math
+
+import settings
+
+
+def hash64(value):
+    """64 bit hash of a value, the same in every process and on every machine."""
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+
+class HyperLogLog:
+    """HyperLogLog sketch of 64 bit hashes, with 2^precision registers.
+
+    The standard error of the estimate is about 1.04 / sqrt(2^precision),
+    0.8% with the default precision of 14, which takes 16 KB.
+    """
+
+    def __init__(self, precision=settings.hll_precision):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add_hash(self, h):
+        bits = 64 - self.precision
+        rest = h & ((1 << bits) - 1)
+        # position of the first 1 bit in what is left after the register index
+        rank = bits - rest.bit_length() + 1
+        index = h >> bits
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(max(a, b) for (a, b) in zip(self.registers, other.registers))
+
+    def error(self):
+        return 1.04 / (len(self.registers) ** 0.5)
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # small cardinalities are counted better by the share of empty registers
+            return m * math.log(m / zeros)
+        return estimate
+
+
+class DistinctCounter:
+    """Counts distinct values exactly, until there are too many of them to keep.
+
+    Hashes of the values are kept in a set until there are more than
+    'limit' of them, then they go to a HyperLogLog sketch, so the memory
+    used stays bounded. Counters of different splits are merged.
+    """
+
+    def __init__(self, limit=settings.distinct_exact_limit, precision=settings.hll_precision):
+        self.limit = limit
+        self.precision = precision
+        self.hashes = set()
+        self.hll = None
+
+    def add(self, value):
+        self.add_hash(hash64(value))
+
+    def add_hash(self, h):
+        if self.hll is not None:
+            self.hll.add_hash(h)
+            return
+        self.hashes.add(h)
+        if len(self.hashes) > self.limit:
+            self._to_hll()
+
+    def _to_hll(self):
+        self.hll = HyperLogLog(self.precision)
+        for h in self.hashes:
+            self.hll.add_hash(h)
+        self.hashes = set()
+
+    def merge(self, other):
+        if other.hll is not None:
+            if self.hll is None:
+                self._to_hll()
+            self.hll.merge(other.hll)
+        for h in other.hashes:
+            self.add_hash(h)
+
+    @property
+    def exact(self):
+        return self.hll is None
+
+    def count(self):
+        if self.hll is None:
+            return len(self.hashes)
+        return round(self.hll.count())
@@ -0,0 +1,67 @@
+import json
+import logging
+import sqlite3
+import time
+
+
+class Journal:
+    """Durable record of finished token ranges and their partial results.
+
+    Finished splits are written to a SQLite database, so that an interrupted
+    run can be resumed without scanning the same token ranges again.
+    The journal remembers the job it belongs to and refuses to resume a
+    different one. Writes are committed at most every 'commit_interval' seconds.
+    """
+
+    def __init__(self, path, job, commit_interval=1):
+        self.path = path
+        self.job = json.dumps(job, sort_keys=True)
+        self.commit_interval = commit_interval
+        self._connection = None
+        self._last_commit = 0
+
+    def open(self, resume=False):
+        """Open the journal, starting a new one unless we are resuming.
+
+        Returns False if the journal belongs to a different job.
+        """
+        self._connection = sqlite3.connect(self.path)
+        self._connection.execute("create table if not exists job (description text)")
+        self._connection.execute("create table if not exists ranges (min integer, max integer, value integer)")
+        row = self._connection.execute("select description from job").fetchone()
+        if resume and row is not None:
+            if row[0] != self.job:
+                logging.warning("Journal {} belongs to a different job: {}".format(self.path, row[0]))
+                return False
+            logging.info("Resuming from journal {}".format(self.path))
+        else:
+            self._connection.execute("delete from job")
+            self._connection.execute("delete from ranges")
+            self._connection.execute("insert into job values (?)", (self.job,))
+        self._connection.commit()
+        self._last_commit = time.time()
+        return True
+
+    def record(self, min, max, value):
+        """Record a finished token range and its result."""
+        self._connection.execute("insert into ranges values (?, ?, ?)", (min, max, value))
+        if time.time() - self._last_commit >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        self._connection.commit()
+        self._last_commit = time.time()
+
+    def completed_ranges(self):
+        return [(r_min, r_max) for (r_min, r_max) in
+                self._connection.execute("select min, max from ranges order by min")]
+
+    def total(self):
+        total = self._connection.execute("select sum(value) from ranges").fetchone()[0]
+        return total or 0
+
+    def close(self):
+        if self._connection:
+            self.commit()
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+import settings
+
+
+def default_participant():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+class Ledger:
+    """Work ledger shared by trireme runs on several machines.
+
+    The token ranges are cut into chunks of up to 'settings.ledger_chunk_splits'
+    splits (at least 'settings.ledger_min_chunks' and at most
+    'settings.ledger_max_chunks' chunks), kept in a SQLite database on
+    shared storage. Every participant leases chunks, scans them and marks
+    them done together with their result. Leases are renewed while the
+    participant is alive, leases of participants that stopped renewing
+    them expire after 'lease_time' seconds and are taken over by others.
+    Chunks a participant could not finish are released when it closes the
+    ledger.
+
+    The ledger is used in place of the journal: finished splits are
+    recorded with record(), and total() adds up results of all participants.
+    The participants' clocks should be roughly in sync.
+    """
+
+    def __init__(self, path, job, participant=None, lease_time=settings.ledger_lease_time):
+        self.path = path
+        self.job = json.dumps(job, sort_keys=True)
+        self.participant = participant or default_participant()
+        self.lease_time = lease_time
+        self.step = None
+        self._connection = None
+        self._progress = {}
+        self._last_renew = 0
+
+    def connect(self):
+        # statements commit right away, leases are taken in explicit transactions
+        self._connection = sqlite3.connect(self.path, timeout=settings.ledger_busy_timeout, isolation_level=None)
+
+    def open(self, ranges, step):
+        """Join the ledger, creating chunks of the ranges if we are the first participant.
+
+        Returns False if the ledger belongs to a different job.
+        """
+        self.step = step
+        self.connect()
+        self._connection.execute("begin immediate")
+        try:
+            self._connection.execute("create table if not exists job (description text)")
+            self._connection.execute("create table if not exists chunks (id integer primary key, min integer, "
+                                     "max integer, state text, owner text, expires real, value integer)")
+            self._connection.execute("create index if not exists chunks_min on chunks (min)")
+            self._connection.execute("create index if not exists chunks_owner on chunks (owner, state)")
+            row = self._connection.execute("select description from job").fetchone()
+            if row is None:
+                self._connection.execute("insert into job values (?)", (self.job,))
+                # chunks are never smaller than a split, there are enough of them
+                # for several participants, and not too many
+                total = sum(range_max - range_min for (range_min, range_max) in ranges)
+                splits = sum(-(-(range_max - range_min) // step) for (range_min, range_max) in ranges)
+                chunk_splits = max(1, min(settings.ledger_chunk_splits, splits // settings.ledger_min_chunks))
+                chunk_step = max(step * chunk_splits, total // settings.ledger_max_chunks + 1)
+                chunks = 0
+                for (range_min, range_max) in ranges:
+                    for chunk_min in range(range_min, range_max, chunk_step):
+                        self._connection.execute("insert into chunks (min, max, state) values (?, ?, 'free')",
+                                                 (chunk_min, min(chunk_min + chunk_step, range_max)))
+                        chunks += 1
+                logging.info("Created ledger {} with {} chunks".format(self.path, chunks))
+            elif row[0] != self.job:
+                logging.warning("Ledger {} belongs to a different job: {}".format(self.path, row[0]))
+                self._connection.execute("rollback")
+                return False
+            # chunks left leased by an earlier run under the same name are never
+            # leased again by us, so they are given back
+            released = self._connection.execute("update chunks set state = 'free', owner = null "
+                                                "where owner = ? and state in ('leased', 'failed')",
+                                                (self.participant,))
+            if released.rowcount:
+                logging.warning("Released {} chunks left unfinished by an earlier run".format(released.rowcount))
+            self._connection.execute("commit")
+        except Exception:
+            self._connection.execute("rollback")
+            raise
+        logging.info("Joined ledger {} as {}".format(self.path, self.participant))
+        return True
+
+    def lease(self):
+        """Lease the next free chunk, or one whose lease expired. Returns (min, max) or None."""
+        now = time.time()
+        self._connection.execute("begin immediate")
+        row = self._connection.execute("select id, min, max, owner from chunks where state = 'free' "
+                                       "or (state = 'leased' and expires < ?) order by id limit 1",
+                                       (now,)).fetchone()
+        if row is None:
+            self._connection.execute("commit")
+            return None
+        (chunk_id, chunk_min, chunk_max, owner) = row
+        self._connection.execute("update chunks set state = 'leased', owner = ?, expires = ? where id = ?",
+                                 (self.participant, now + self.lease_time, chunk_id))
+        self._connection.execute("commit")
+        if owner and owner != self.participant:
+            logging.warning("Taking over chunk {} - {} from {}".format(chunk_min, chunk_max, owner))
+        return (chunk_min, chunk_max)
+
+    def leased(self):
+        """Return the number of chunks we hold leases of and are still working on.
+
+        Chunks with a failed split are not counted, they can't be finished.
+        """
+        row = self._connection.execute("select count(*) from chunks where owner = ? and state = 'leased'",
+                                       (self.participant,)).fetchone()
+        return row[0]
+
+    def others_working(self):
+        """Return True if other participants hold leases that have not expired."""
+        row = self._connection.execute("select count(*) from chunks where state = 'leased' and owner != ? "
+                                       "and expires >= ?", (self.participant, time.time())).fetchone()
+        return row[0] > 0
+
+    def record(self, min, max, value):
+        """Record a finished split, marking its chunk done once all of its splits are finished."""
+        (chunk_id, chunk_min, chunk_max) = self._connection.execute(
+            "select id, min, max from chunks where min <= ? order by min desc limit 1", (min,)).fetchone()
+        if chunk_id not in self._progress:
+            self._progress[chunk_id] = [-(-(chunk_max - chunk_min) // self.step), 0]
+        progress = self._progress[chunk_id]
+        progress[0] -= 1
+        progress[1] += value
+        if progress[0] <= 0:
+            del self._progress[chunk_id]
+            done = self._connection.execute("update chunks set state = 'done', value = ? where id = ? "
+                                            "and owner = ? and state = 'leased'",
+                                            (progress[1], chunk_id, self.participant))
+            if not done.rowcount:
+                logging.warning("Lost the lease of chunk {} - {}, its result is dropped".format(chunk_min, chunk_max))
+        self.commit()
+
+    def fail(self, min, max):
+        """Mark the chunk of a split that was given up on as failed, it is released when we close the ledger."""
+        (chunk_id, chunk_min, chunk_max) = self._connection.execute(
+            "select id, min, max from chunks where min <= ? order by min desc limit 1", (min,)).fetchone()
+        self._connection.execute("update chunks set state = 'failed' where id = ? and owner = ? and state = 'leased'",
+                                 (chunk_id, self.participant))
+        logging.warning("Split {} - {} failed, chunk {} - {} is left for later".format(min, max, chunk_min, chunk_max))
+
+    def commit(self):
+        """Renew our leases, at most a few times per lease time."""
+        if time.time() - self._last_renew >= self.lease_time / 4:
+            self._connection.execute("update chunks set expires = ? where owner = ? and state = 'leased'",
+                                     (time.time() + self.lease_time, self.participant))
+            self._last_renew = time.time()
+
+    def total(self):
+        """Add up results of the chunks all participants have finished."""
+        total = self._connection.execute("select sum(value) from chunks where state = 'done'").fetchone()[0]
+        return total or 0
+
+    def unfinished(self):
+        return self._connection.execute("select count(*) from chunks where state != 'done'").fetchone()[0]
+
+    def close(self, release=True):
+        """Close the ledger, releasing chunks we have not finished so that others can take them."""
+        if self._connection:
+            if release:
+                released = self._connection.execute("update chunks set state = 'free', owner = null "
+                                                    "where owner = ? and state in ('leased', 'failed')",
+                                                    (self.participant,))
+                if released.rowcount:
+                    logging.warning("Released {} unfinished chunks".format(released.rowcount))
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,204 @@
+import bisect
+import http.server
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import settings
+
+help_texts = {
+    "splits": "Splits created by the splitter",
+    "mapper": "Tasks created by the mapper",
+    "results": "Splits finished by workers",
+    "rows": "Rows read",
+    "deleted": "Rows deleted",
+    "deleted_partitions": "Whole partitions deleted",
+    "updated": "Rows updated",
+    "results_consumed": "Splits processed by the main process",
+    "errors": "Failed queries",
+    "retries": "Failed pages retried by the same worker",
+    "requeued": "Tasks put back to be continued by another worker",
+    "failed": "Splits given up on, missing from the result",
+    "tokens": "Tokens scanned",
+}
+
+
+class LatencyHistogram:
+    """Query latency histogram with fixed buckets, in seconds."""
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or settings.metrics_latency_buckets
+        # the last count is for latencies over the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, latency):
+        self.counts[bisect.bisect_left(self.buckets, latency)] += 1
+        self.sum += latency
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for (a, b) in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def cumulative(self):
+        """Return list of (upper bound, count of latencies up to it) tuples."""
+        result = []
+        total = 0
+        for (bound, count) in zip(self.buckets + ["+Inf"], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def queue_depths(queues):
+    depths = {}
+    for name in ["split_queue", "mapper_queue", "worker_queue", "results_queue", "retry_queue"]:
+        try:
+            depths[name[:-len("_queue")]] = getattr(queues, name).qsize()
+        except NotImplementedError:
+            # qsize() is not available on macOS
+            depths[name[:-len("_queue")]] = None
+    return depths
+
+
+def token_progress(counts, rsettings):
+    """Return share of the token range that has been scanned."""
+    if rsettings.split_ranges is not None:
+        total = sum(r_max - r_min for (r_min, r_max) in rsettings.split_ranges)
+    else:
+        total = rsettings.tr.max - rsettings.tr.min
+    if total <= 0:
+        return 1.0
+    return min(1.0, counts["tokens"] / total)
+
+
+class Metrics:
+    """Latest metrics of the run, rendered as OpenMetrics text or JSON."""
+
+    def __init__(self, queues, rsettings):
+        self.queues = queues
+        self.rsettings = rsettings
+        self.started = time.time()
+        self.latencies = {}
+        self._lock = threading.Lock()
+
+    def merge_latencies(self, histograms):
+        with self._lock:
+            for (host, histogram) in histograms.items():
+                if host in self.latencies:
+                    self.latencies[host].merge(histogram)
+                else:
+                    self.latencies[host] = histogram
+
+    def snapshot(self):
+        counts = self.queues.stats.snapshot()
+        with self._lock:
+            latencies = dict((host, {"buckets": [[str(bound), count] for (bound, count) in h.cumulative()],
+                                     "sum": h.sum, "count": h.count})
+                             for (host, h) in self.latencies.items())
+        snapshot = {"time": time.time(), "elapsed": time.time() - self.started,
+                    "keyspace": self.rsettings.keyspace, "table": self.rsettings.table,
+                    "counters": counts, "queues": queue_depths(self.queues),
+                    "progress": token_progress(counts, self.rsettings), "latency": latencies}
+        if self.rsettings.rate_limiter:
+            snapshot["rate_limit"] = self.rsettings.rate_limiter.rate
+        return snapshot
+
+    def openmetrics(self):
+        snapshot = self.snapshot()
+        lines = []
+        for (name, value) in snapshot["counters"].items():
+            lines.append("# TYPE trireme_{} counter".format(name))
+            lines.append("# HELP trireme_{} {}".format(name, help_texts.get(name, name)))
+            lines.append("trireme_{}_total {}".format(name, value))
+        lines.append("# TYPE trireme_queue_depth gauge")
+        lines.append("# HELP trireme_queue_depth Items waiting in the queue")
+        for (name, depth) in snapshot["queues"].items():
+            if depth is not None:
+                lines.append('trireme_queue_depth{{queue="{}"}} {}'.format(name, depth))
+        lines.append("# TYPE trireme_progress gauge")
+        lines.append("# HELP trireme_progress Share of the token range scanned")
+        lines.append("trireme_progress {}".format(snapshot["progress"]))
+        if "rate_limit" in snapshot:
+            lines.append("# TYPE trireme_rate_limit gauge")
+            lines.append("# HELP trireme_rate_limit Current query rate limit per second")
+            lines.append("trireme_rate_limit {}".format(snapshot["rate_limit"]))
+        lines.append("# TYPE trireme_query_latency_seconds histogram")
+        lines.append("# HELP trireme_query_latency_seconds Query latency by coordinator host")
+        for (host, h) in sorted(snapshot["latency"].items()):
+            for (bound, count) in h["buckets"]:
+                lines.append('trireme_query_latency_seconds_bucket{{host="{}",le="{}"}} {}'.format(host, bound, count))
+            lines.append('trireme_query_latency_seconds_sum{{host="{}"}} {}'.format(host, h["sum"]))
+            lines.append('trireme_query_latency_seconds_count{{host="{}"}} {}'.format(host, h["count"]))
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+def write_snapshot(metrics, path):
+    """Write JSON snapshot, replacing the old one at once so readers never see half a file."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(metrics.snapshot(), f)
+    os.replace(tmp_path, path)
+
+
+def start_http_server(metrics, port):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = metrics.openmetrics().encode()
+                content_type = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+            elif self.path == "/metrics.json":
+                body = json.dumps(metrics.snapshot()).encode()
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("Metrics request: " + format % args)
+
+    server = http.server.ThreadingHTTPServer((settings.metrics_address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logging.info("Serving metrics on http://{}:{}/metrics".format(settings.metrics_address, port))
+    return server
+
+
+def metrics_server(queues, rsettings):
+    """Collect latency histograms from workers, serve metrics over HTTP and write JSON snapshots."""
+    metrics = Metrics(queues, rsettings)
+    server = None
+    if rsettings.metrics_port:
+        server = start_http_server(metrics, rsettings.metrics_port)
+    last_snapshot = 0
+    while not queues.kill.is_set():
+        try:
+            metrics.merge_latencies(queues.latency_queue.get(True, 1))
+        except queue.Empty:
+            pass
+        if rsettings.metrics_file and time.time() - last_snapshot >= settings.metrics_snapshot_interval:
+            write_snapshot(metrics, rsettings.metrics_file)
+            last_snapshot = time.time()
+    # workers have flushed their stats by now
+    while True:
+        try:
+            metrics.merge_latencies(queues.latency_queue.get_nowait())
+        except queue.Empty:
+            break
+    if rsettings.metrics_file:
+        write_snapshot(metrics, rsettings.metrics_file)
+    if server:
+        server.shutdown()
+    logging.debug("Metrics server exiting.")
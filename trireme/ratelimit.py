@@ -0,0 +1,94 @@
+import logging
+import multiprocessing
+import time
+
+
+class RateLimiter:
+    """Token bucket for queries per second, shared between processes.
+
+    Every query takes a token from the bucket, which is refilled at the
+    current rate. The rate is adjusted every 'adjust_interval' seconds
+    with AIMD: when queries fail or too many of them are slower than
+    'target_latency', the rate is multiplied by 'decrease', otherwise it
+    grows by 'increase' * 'max_rate'. It always stays between 'min_rate'
+    and 'max_rate' and starts from 'min_rate', so the cluster is probed
+    gently before going faster.
+    """
+
+    def __init__(self, max_rate, min_rate, target_latency, adjust_interval=1, increase=0.05, decrease=0.5,
+                 slow_share=0.1, burst=0.1):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.target_latency = target_latency
+        self.adjust_interval = adjust_interval
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_share = slow_share
+        self.burst = burst
+        self._lock = multiprocessing.Lock()
+        self._rate = multiprocessing.RawValue("d", self.min_rate)
+        self._tokens = multiprocessing.RawValue("d", 0)
+        self._refilled = multiprocessing.RawValue("d", time.time())
+        # feedback collected since the last adjustment
+        self._window_start = multiprocessing.RawValue("d", time.time())
+        self._window_queries = multiprocessing.RawValue("q", 0)
+        self._window_slow = multiprocessing.RawValue("q", 0)
+        self._window_errors = multiprocessing.RawValue("q", 0)
+
+    def __str__(self):
+        return "RateLimiter(rate: {:.0f}, min: {}, max: {})".format(self.rate, self.min_rate, self.max_rate)
+
+    @property
+    def rate(self):
+        return self._rate.value
+
+    def _take(self, now):
+        """Refill the bucket and take a token. Returns seconds to wait if there was none."""
+        rate = self._rate.value
+        capacity = max(1, rate * self.burst)
+        self._tokens.value = min(capacity, self._tokens.value + (now - self._refilled.value) * rate)
+        self._refilled.value = now
+        if self._tokens.value >= 1:
+            self._tokens.value -= 1
+            return 0
+        return (1 - self._tokens.value) / rate
+
+    def acquire(self):
+        """Wait until the query is allowed to run."""
+        while True:
+            with self._lock:
+                wait = self._take(time.time())
+            if not wait:
+                return
+            time.sleep(min(wait, 0.1))
+
+    def feedback(self, latency=0, error=False):
+        """Report how a query went, adjusting the rate if it is time to."""
+        with self._lock:
+            self._window_queries.value += 1
+            if error:
+                self._window_errors.value += 1
+            elif latency > self.target_latency:
+                self._window_slow.value += 1
+            now = time.time()
+            elapsed = now - self._window_start.value
+            if elapsed >= self.adjust_interval:
+                self._adjust(elapsed)
+                self._window_start.value = now
+                self._window_queries.value = 0
+                self._window_slow.value = 0
+                self._window_errors.value = 0
+
+    def _adjust(self, elapsed):
+        rate = self._rate.value
+        queries = self._window_queries.value
+        if self._window_errors.value or self._window_slow.value > queries * self.slow_share:
+            new_rate = max(self.min_rate, rate * self.decrease)
+        elif queries >= rate * elapsed / 2:
+            # only speed up when the current rate is actually used
+            new_rate = min(self.max_rate, rate + self.max_rate * self.increase)
+        else:
+            return
+        if new_rate != rate:
+            logging.info("Changing query rate from {:.0f}/s to {:.0f}/s".format(rate, new_rate))
+            self._rate.value = new_rate
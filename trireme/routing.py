@@ -0,0 +1,37 @@
+import logging
+import random
+
+
+class ReplicaRouter:
+    """Pick a replica that owns the token range of a split.
+
+    Range queries have no routing key, so the driver's token aware policy
+    sends them to any coordinator, which then has to fetch the data from
+    the replicas. The router sends every split straight to one of its
+    replicas instead.
+
+    A split is routed by its first token. Ring aware splits never cross
+    a vnode boundary, so all of their rows are served by the picked host.
+    Only hosts the session has connection pools for are used, so replicas
+    in other datacenters are skipped when DCAwareRoundRobinPolicy is set.
+    """
+
+    def __init__(self, session, keyspace):
+        self.keyspace = keyspace
+        self.token_map = session.cluster.metadata.token_map
+        self.connected = set(session.get_pool_state())
+        logging.debug("Routing splits to {} connected hosts".format(len(self.connected)))
+
+    def replicas(self, token):
+        """Return connected hosts that are up and own the token."""
+        if self.token_map is None:
+            return []
+        hosts = self.token_map.get_replicas(self.keyspace, self.token_map.token_class(token))
+        return [h for h in hosts if h in self.connected and h.is_up is not False]
+
+    def host(self, split_min):
+        """Return a random replica of the split, or None to let the driver decide."""
+        replicas = self.replicas(split_min)
+        if not replicas:
+            return None
+        return random.choice(replicas)
@@ -0,0 +1,99 @@
+import bisect
+import multiprocessing
+import random
+
+import settings
+
+
+class RandomOrder:
+    """Pseudo random permutation of 0 .. count - 1, computed index by index.
+
+    A balanced Feistel network permutes numbers of an even number of bits,
+    numbers that fall outside of the range are permuted again until they
+    are in it (cycle walking), which takes fewer than 4 rounds on average.
+    """
+
+    rounds = 4
+
+    def __init__(self, count, seed=None):
+        self.count = count
+        bits = max(2, (count - 1).bit_length())
+        self.half = (bits + 1) // 2
+        self.mask = (1 << self.half) - 1
+        rng = random.Random(seed)
+        self.keys = [rng.getrandbits(64) for i in range(self.rounds)]
+
+    def _round(self, value, key):
+        value = ((value ^ key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        return (value ^ (value >> 29)) & self.mask
+
+    def __call__(self, index):
+        while True:
+            (left, right) = (index >> self.half, index & self.mask)
+            for key in self.keys:
+                (left, right) = (right, left ^ self._round(right, key))
+            index = (left << self.half) | right
+            if index < self.count:
+                return index
+
+
+class SplitPlan:
+    """Splits of token ranges, computed from their index instead of being queued.
+
+    Every range is cut in steps of 'step' tokens separately, so that no
+    split crosses range boundaries, and splits are numbered across all the
+    ranges. Workers claim chunks of split indices from a counter shared
+    between processes and build the splits themselves, so millions of
+    splits cost a few bytes.
+
+    Chunks get smaller as fewer splits are left (guided scheduling), so
+    that workers still finish at about the same time.
+
+    With 'shuffle' splits are handed out in random order, for sampling.
+    """
+
+    def __init__(self, ranges, step, max_chunk=settings.split_claim_size, shuffle=False):
+        self.step = step
+        self.max_chunk = max_chunk
+        self.ranges = [(r_min, r_max) for (r_min, r_max) in ranges if r_max > r_min]
+        # index of the first split of every range
+        self.offsets = []
+        self.count = 0
+        for (r_min, r_max) in self.ranges:
+            self.offsets.append(self.count)
+            self.count += -(-(r_max - r_min) // step)
+        self.order = RandomOrder(self.count) if shuffle and self.count else None
+        self._lock = multiprocessing.Lock()
+        # unsigned, 2^64 single token splits do not fit in a signed 64 bit integer
+        self._next = multiprocessing.RawValue("Q", 0)
+
+    def __str__(self):
+        return "SplitPlan(splits: {}, step: {}, ranges: {})".format(self.count, self.step, len(self.ranges))
+
+    def split(self, index):
+        """Return (min, max) token range of the split with the index."""
+        if self.order:
+            index = self.order(index)
+        i = bisect.bisect_right(self.offsets, index) - 1
+        (r_min, r_max) = self.ranges[i]
+        split_min = r_min + (index - self.offsets[i]) * self.step
+        return (split_min, min(split_min + self.step, r_max))
+
+    def claim(self, claimers=1):
+        """Claim the next chunk of split indices, shared by 'claimers' threads in total.
+
+        Returns (first, last + 1) tuple, or None if all splits have been claimed.
+        """
+        with self._lock:
+            first = self._next.value
+            remaining = self.count - first
+            if remaining <= 0:
+                return None
+            size = max(1, min(self.max_chunk, remaining // (claimers * 4)))
+            self._next.value = first + size
+        return (first, first + size)
+
+    def stop(self):
+        """Stop handing out splits, splits claimed so far are still run."""
+        with self._lock:
+            self._next.value = self.count
@@ -1,123 +1,199 @@
 import datetime
 import logging
+import math
+import multiprocessing
+import queue
+import threading
 import time
 
+from trireme.metrics import LatencyHistogram
 from trireme.presentation import human_time
 
 
-def stats_monitor(queues, rsettings):
-    start_time = datetime.datetime.now()
-    stats_split_count = 0
-    stats_split_count_delta = 0
-    stats_map_count = 0
-    stats_deleted_count = 0
-    stats_delete_scheduled_count = 0
-    stats_map_count_delta = 0
-    stats_worker_count = 0
-    stats_result_count = 0
-    stats_result_count_delta = 0
-    stats_result_consumed_count = 0
-    stats_result_consumed_count_delta = 0
+class StatsCounters:
+    """Event counters shared between processes.
 
+    Counters live in shared memory. Every process accumulates its events
+    locally and adds them to the shared counters at most every
+    'flush_interval' seconds, so counting an event is just a dictionary update.
+    Processes should call flush() before they go idle or exit. Threads of
+    a process share the local counts.
 
-    sleep_time = 1 # default sleep time
-    predicted_split_count = round(split_predicter(rsettings.tr,rsettings.split))
-    last_iteration_time = None
-    overall_start_time = datetime.datetime.now()
-    while not queues.kill.is_set():
-        iteration_start = datetime.datetime.now()
-        # TODO: refactor this to use a map of queue and stats counter and do it in a loop instead of 3 conditionals
-        if not queues.stats_queue_splits.empty():
-            try:
-                stats_split_count_prev = stats_split_count
-                while not queues.stats_queue_splits.empty():
-                    queues.stats_queue_splits.get()
-                    stats_split_count += 1
-                stats_split_count_delta = stats_split_count - stats_split_count_prev
+    Query latencies are collected per host in local histograms as well,
+    which are sent to 'latency_queue' on flush.
+    """
+    names = ["splits", "mapper", "results", "rows", "deleted", "deleted_partitions", "updated", "results_consumed",
+             "errors", "retries", "requeued", "failed", "tokens"]
+    # token counts do not fit in a signed 64 bit integer
+    float_names = ["tokens"]
 
-            except:
-                logging.warning("Stats queue for splits empty, but noone else should have been consuming it.")
+    def __init__(self, flush_interval=0.5, latency_queue=None):
+        self.flush_interval = flush_interval
+        self.latency_queue = latency_queue
+        self._values = {name: multiprocessing.Value("d" if name in self.float_names else "q", 0)
+                        for name in self.names}
+        self._local = {}
+        self._latencies = {}
+        self._local_lock = threading.Lock()
+        self._last_flush = time.time()
 
-        if not queues.stats_queue_mapper.empty():
-            try:
-                stats_map_count_prev = stats_map_count
-                while not queues.stats_queue_mapper.empty():
-                    queues.stats_queue_mapper.get()
-                    stats_map_count += 1
-                stats_map_count_delta = stats_map_count - stats_map_count_prev
-            except:
-                logging.warning("Stats queue for mapper empty, but noone else should have been consuming it.")
-
-        if not queues.stats_queue_results.empty():
-            try:
-                stats_result_count_prev = stats_result_count
-                while not queues.stats_queue_results.empty():
-                    queues.stats_queue_results.get()
-                    stats_result_count += 1
-                stats_result_count_delta = stats_result_count - stats_result_count_prev
-            except:
-                logging.warning("Stats queue for results empty, but noone else should have been consuming it.")
-        if not queues.stats_queue_results_consumed.empty():
-            try:
-                while not queues.stats_queue_results_consumed.empty():
-                    queues.stats_queue_results_consumed.get()
-                    stats_result_consumed_count += 1
-            except:
-                logging.warning("Stats queue for results_consumed empty, but noone else should have been consuming it.")
+    def __getstate__(self):
+        # locks can't be pickled for spawned processes, which start with no local counts of their own
+        state = dict(self.__dict__)
+        state["_local"] = {}
+        state["_latencies"] = {}
+        del state["_local_lock"]
+        return state
 
-        if not queues.stats_queue_deleted.empty():
-            try:
-                while not queues.stats_queue_deleted.empty():
-                    queues.stats_queue_deleted.get()
-                    stats_deleted_count += 1
-            except:
-                logging.warning("Stats queue for deleted empty, but noone else should have been consuming it.")
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local_lock = threading.Lock()
+
+    def observe(self, host, latency):
+        """Add query latency of the host to the latency histograms."""
+        with self._local_lock:
+            if host not in self._latencies:
+                self._latencies[host] = LatencyHistogram()
+            self._latencies[host].observe(latency)
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def add(self, name, count=1):
+        with self._local_lock:
+            self._local[name] = self._local.get(name, 0) + count
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
 
-        if not queues.stats_queue_delete_scheduled.empty():
+    def flush(self):
+        with self._local_lock:
+            local = self._local
+            latencies = self._latencies
+            self._local = {}
+            self._latencies = {}
+            self._last_flush = time.time()
+        for name, count in local.items():
+            value = self._values[name]
+            with value.get_lock():
+                value.value += count
+        if latencies and self.latency_queue is not None:
             try:
-                while not queues.stats_queue_delete_scheduled.empty():
-                    queues.stats_queue_delete_scheduled.get()
-                    stats_delete_scheduled_count += 1
-            except:
-                logging.warning("Stats queue for delete scheduled empty, but noone else should have been consuming it.")
+                self.latency_queue.put_nowait(latencies)
+            except queue.Full:
+                logging.debug("Latency queue is full, dropping latencies")
+
+    def get(self, name):
+        return self._values[name].value
+
+    def snapshot(self):
+        return {name: self.get(name) for name in self.names}
+
+
+def stats_monitor(queues, rsettings):
+    sleep_time = 1 # default sleep time
+    predicted_split_count = round(split_predicter(rsettings.tr, rsettings.split, rsettings.split_ranges))
+    last_iteration_time = None
+    last_counts = queues.stats.snapshot()
+    while not queues.kill.is_set():
+        iteration_start = datetime.datetime.now()
+        counts = queues.stats.snapshot()
+        deltas = {name: counts[name] - last_counts[name] for name in counts}
+        last_counts = counts
 
         if last_iteration_time:
             iteration_delta = iteration_start - last_iteration_time
-            result_rate = round(stats_result_count_delta / iteration_delta.total_seconds())
-            results_remaining = predicted_split_count - stats_result_count
-            if result_rate == 0:
-                continue
-            seconds_remaining = results_remaining / result_rate
-            percent = predicted_split_count / 100
-            # avoid division by zero in the very beginning,
-            # when not enough work is done yet
-            if percent == 0:
-                done_percent = 0
-            else:
-                done_percent = round(stats_result_count / percent)
-
-
-            print()
-            print("Performance::  splits: {}/{} ({}), maps: {} ({}), results consumption: {}/{} ({})".format(
-                stats_split_count, predicted_split_count, stats_split_count_delta, stats_map_count,
-                stats_map_count_delta, stats_result_consumed_count, stats_result_count, stats_result_count_delta))
-            print("{}% done. {} results/s. Time remaining: {}".format(done_percent, result_rate, human_time(seconds_remaining)))
-            if stats_delete_scheduled_count >0:
-                print("Deleted {}/{} rows".format(stats_deleted_count,stats_delete_scheduled_count))
-            # how often we print updates depends on how much time the
-            # script execution is expected to take
-            if seconds_remaining > 120:
-                sleep_time = 10
-            elif seconds_remaining > 60:
-                sleep_time = 5
-            else: sleep_time = 2
-        time.sleep(sleep_time)
+            result_rate = round(deltas["results"] / iteration_delta.total_seconds())
+            results_remaining = predicted_split_count - counts["results"]
+            if result_rate > 0:
+                seconds_remaining = results_remaining / result_rate
+                percent = predicted_split_count / 100
+                # avoid division by zero in the very beginning,
+                # when not enough work is done yet
+                if percent == 0:
+                    done_percent = 0
+                else:
+                    done_percent = round(counts["results"] / percent)
+
+                print()
+                print("Performance::  splits: {}/{} ({}), maps: {} ({}), results consumption: {}/{} ({}), rows: {} ({})".format(
+                    counts["splits"], predicted_split_count, deltas["splits"], counts["mapper"],
+                    deltas["mapper"], counts["results_consumed"], counts["results"], deltas["results"],
+                    counts["rows"], deltas["rows"]))
+                print("{}% done. {} results/s. Time remaining: {}".format(done_percent, result_rate, human_time(seconds_remaining)))
+                if counts["deleted_partitions"] > 0:
+                    print("Deleted {} partitions".format(counts["deleted_partitions"]))
+                if counts["deleted"] > 0:
+                    print("Deleted {} rows".format(counts["deleted"]))
+                if counts["updated"] > 0:
+                    print("Updated {} rows".format(counts["updated"]))
+                if rsettings.rate_limiter:
+                    print("Query rate limit: {:.0f}/s".format(rsettings.rate_limiter.rate))
+                # how often we print updates depends on how much time the
+                # script execution is expected to take
+                if seconds_remaining > 120:
+                    sleep_time = 10
+                elif seconds_remaining > 60:
+                    sleep_time = 5
+                else: sleep_time = 2
+        queues.kill.wait(sleep_time)
         last_iteration_time = iteration_start
     else:
         logging.debug("Stats monitor exiting.")
 
 
-def split_predicter(tr, split):
+def split_predicter(tr, split, ranges=None):
     # how many splits will there be?
+    if ranges:
+        # every range is split separately, so each one adds at least one split
+        step = pow(10, split)
+        return sum(-(-(r_max - r_min) // step) for (r_min, r_max) in ranges)
     predicted_split_count = (tr.max - tr.min) / pow(10, split)
-    return predicted_split_count
\ No newline at end of file
+    return predicted_split_count
+
+
+class SampleEstimator:
+    """Estimate of the total row count from a random sample of splits.
+
+    Every split is turned into rows per token, and their mean times the
+    tokens of all the splits is the estimate. The confidence interval
+    comes from the standard error of the mean, with the finite population
+    correction, so it shrinks to zero once every split has been counted.
+    """
+
+    def __init__(self, tokens, splits, z=1.96):
+        self.tokens = tokens
+        self.splits = splits
+        self.z = z
+        self.samples = 0
+        self.rows = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, rows, tokens):
+        density = rows / tokens
+        self.samples += 1
+        self.rows += rows
+        delta = density - self._mean
+        self._mean += delta / self.samples
+        self._m2 += delta * (density - self._mean)
+
+    def estimate(self):
+        if self.samples >= self.splits:
+            # everything has been counted
+            return self.rows
+        return self._mean * self.tokens
+
+    def margin(self):
+        """Half width of the confidence interval of the estimate."""
+        if self.samples >= self.splits:
+            return 0
+        if self.samples < 2:
+            return float("inf")
+        variance = self._m2 / (self.samples - 1)
+        correction = 1 - self.samples / self.splits
+        return self.z * self.tokens * math.sqrt(variance / self.samples * correction)
+
+    def good_enough(self, error, min_samples):
+        """Return True when the margin is within 'error' share of the estimate."""
+        if self.samples >= self.splits:
+            return True
+        return self.samples >= min_samples and self.margin() <= error * self.estimate()
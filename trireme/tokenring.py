@@ -0,0 +1,87 @@
+import logging
+
+import settings
+
+
+def tokens_from_token_map(token_map):
+    """Return sorted list of integer tokens from the driver's TokenMap."""
+    return sorted(token.value for token in token_map.ring)
+
+
+def tokens_from_file(path):
+    """Read ring tokens from a local metadata file.
+
+    The file can either contain one token per line or be the output
+    of `nodetool ring`, in which case the token is the last column.
+    Lines where the last column is not an integer (headers, comments)
+    are skipped.
+    """
+    tokens = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            try:
+                tokens.append(int(fields[-1]))
+            except ValueError:
+                logging.debug("Skipping ring file line: {}".format(line.strip()))
+    return sorted(set(tokens))
+
+
+def owned_ranges(tokens, tr):
+    """Turn ring tokens into the token ranges owned by each vnode.
+
+    A node with token T owns the range (previous token, T], but trireme
+    queries use 'token >= min and token < max', so every range is shifted
+    by one. The range that wraps around the ring is split in two.
+    Resulting ranges are clipped to the token range 'tr' and returned as
+    a sorted list of (min, max) tuples.
+    """
+    if not tokens:
+        return [(tr.min, tr.max)]
+    tokens = sorted(tokens)
+    ranges = [(settings.default_min_token, tokens[0] + 1)]
+    for prev, token in zip(tokens, tokens[1:]):
+        ranges.append((prev + 1, token + 1))
+    ranges.append((tokens[-1] + 1, settings.default_max_token))
+
+    clipped = []
+    for (r_min, r_max) in ranges:
+        r_min = max(r_min, tr.min)
+        r_max = min(r_max, tr.max)
+        if r_min < r_max:
+            clipped.append((r_min, r_max))
+    return clipped
+
+
+def merge_ranges(ranges):
+    """Merge overlapping and adjacent (min, max) ranges into a sorted list."""
+    merged = []
+    for (r_min, r_max) in sorted(ranges):
+        if merged and r_min <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], r_max))
+        else:
+            merged.append((r_min, r_max))
+    return merged
+
+
+def subtract_ranges(ranges, done):
+    """Return parts of 'ranges' that are not covered by 'done' ranges."""
+    done = merge_ranges(done)
+    remaining = []
+    for (r_min, r_max) in ranges:
+        i = r_min
+        for (d_min, d_max) in done:
+            if d_max <= i:
+                continue
+            if d_min >= r_max:
+                break
+            if d_min > i:
+                remaining.append((i, d_min))
+            i = d_max
+            if i >= r_max:
+                break
+        if i < r_max:
+            remaining.append((i, r_max))
+    return remaining
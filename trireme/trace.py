@@ -0,0 +1,112 @@
+import csv
+import logging
+import queue
+
+import settings
+from trireme.datastructures import TopK
+
+fields = ["split_min", "split_max", "queue_wait", "execute", "total", "pages", "rows", "bytes", "attempts",
+          "host", "failed"]
+
+
+def estimate_size(rows):
+    """Rough size of rows in bytes: length of text and blobs, 8 bytes for any other value."""
+    size = 0
+    for row in rows:
+        for value in row:
+            if value is None:
+                continue
+            if isinstance(value, (str, bytes, bytearray)):
+                size += len(value)
+            else:
+                size += 8
+    return size
+
+
+def trace_record(task, finished, failed=False):
+    """Return trace line of a task, as a list of 'fields'."""
+    queue_wait = task.started - task.created if task.started else 0
+    total = finished - task.started if task.started else 0
+    return [task.split_min, task.split_max, round(queue_wait, 4), round(task.execute_time, 4), round(total, 4),
+            task.pages, task.rows, task.bytes, task.attempts + 1, task.host or "", int(failed)]
+
+
+def trace_writer(queues, rsettings):
+    """Write trace records sent by workers to the trace file, one CSV line per split.
+
+    The file is appended to, main process truncates it before the run.
+    """
+    with open(rsettings.trace_file, "a", newline="") as f:
+        writer = csv.writer(f)
+        while not queues.kill.is_set():
+            try:
+                writer.writerow(queues.trace_queue.get(True, 1))
+            except queue.Empty:
+                f.flush()
+        # workers have sent their last records by now, give them a moment to arrive
+        while True:
+            try:
+                writer.writerow(queues.trace_queue.get(True, 1))
+            except queue.Empty:
+                break
+    logging.debug("Trace writer exiting.")
+
+
+def start_trace(path):
+    with open(path, "w", newline="") as f:
+        csv.writer(f).writerow(fields)
+
+
+def read_trace(path):
+    with open(path, newline="") as f:
+        for line in csv.DictReader(f):
+            for name in ["split_min", "split_max", "pages", "rows", "bytes", "attempts", "failed"]:
+                line[name] = int(line[name])
+            for name in ["queue_wait", "execute", "total"]:
+                line[name] = float(line[name])
+            yield line
+
+
+def trace_report(path, top=settings.trace_report_top):
+    """Summarize the trace: slowest and largest token ranges, failed ranges and time per host."""
+    slowest = TopK(top)
+    largest = TopK(top)
+    failed = []
+    hosts = {}
+    splits = 0
+    queue_wait = 0
+    for line in read_trace(path):
+        split = (line["split_min"], line["split_max"])
+        splits += 1
+        queue_wait += line["queue_wait"]
+        slowest.add(line["execute"], (split, line["rows"], line["host"]))
+        largest.add(line["bytes"], (split, line["rows"], line["host"]))
+        if line["failed"]:
+            failed.append(split)
+        host = hosts.setdefault(line["host"] or "unknown", [0, 0, 0])
+        host[0] += 1
+        host[1] += line["execute"]
+        host[2] += line["rows"]
+    return {"splits": splits, "queue_wait": queue_wait / max(splits, 1), "slowest": slowest.items(),
+            "largest": largest.items(), "failed": sorted(failed), "hosts": hosts}
+
+
+def print_trace_report(path, top=settings.trace_report_top):
+    report = trace_report(path, top)
+    print("Trace of {} splits written to {}, average queue wait {:.3f}s".format(
+        report["splits"], path, report["queue_wait"]))
+    print("Slowest token ranges:")
+    for (execute, ((split_min, split_max), rows, host)) in report["slowest"]:
+        print("    {:.3f}s for {} rows in token range {} - {} on {}".format(
+            execute, rows, split_min, split_max, host or "unknown"))
+    print("Largest token ranges:")
+    for (size, ((split_min, split_max), rows, host)) in report["largest"]:
+        print("    {} bytes in {} rows in token range {} - {} on {}".format(
+            size, rows, split_min, split_max, host or "unknown"))
+    if report["failed"]:
+        print("Failed token ranges:")
+        for (split_min, split_max) in report["failed"]:
+            print("    {} - {}".format(split_min, split_max))
+    print("Hosts:")
+    for (host, (splits, execute, rows)) in sorted(report["hosts"].items()):
+        print("    {}: {} splits, {} rows, {:.3f}s per split".format(host, splits, rows, execute / splits))